@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+"""
+End-to-end acquisition benchmark
+
+Drives SerialPort.request_stream -> parse_serial -> Persistor.insert_stream -> protocol callback
+against a simulated controller, for several stream definition shapes, and reports packets/s,
+samples/s, p50/p99 latency of each stage, CPU time per packet and bytes written.
+
+Usage:
+    python benchmarks/acquisition_benchmark.py [--packets N] [--shapes quick|full]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import optparse
+try:
+    import resource
+except ImportError:
+    resource = None # Windows
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+# headless, see voyeur.eventloop
+os.environ.setdefault('ETS_TOOLKIT', 'null')
+from voyeur import db
+from voyeur.arduino import SerialPort, StreamPlan
+from voyeur.simulator import SimulatedController, SimulatedChannel, SimulatedSerial
+
+
+# (channels, arduino type, samples per channel and packet)
+QUICK_SHAPES = [
+    (1, 'int', 50),
+    (4, 'int', 50),
+    (4, 'long', 50),
+    (4, 'int', 500),
+]
+FULL_SHAPES = [(channels, arduinoType, samples)
+               for channels in (1, 2, 4, 8)
+               for arduinoType in ('int', 'long')
+               for samples in (10, 50, 200, 1000)]
+
+STAGES = ('serial', 'decode', 'persist', 'callback')
+
+
+class SteppedClock(object):
+    """Controller clock advanced by the benchmark, so every packet holds the same number of samples"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TimedSerialPort(SerialPort):
+    """SerialPort that accumulates the time spent waiting for serial reads"""
+
+    io_seconds = 0.0
+
+    def read_line(self):
+        start = time.time()
+        line = SerialPort.read_line(self)
+        self.io_seconds += time.time() - start
+        return line
+
+    def read_byte_streams(self, num_bytes):
+        start = time.time()
+        bytestream = SerialPort.read_byte_streams(self, num_bytes)
+        self.io_seconds += time.time() - start
+        return bytestream
+
+
+class Callback(object):
+    """Stand-in for a protocol's process_stream_request: keeps a running mean of every stream"""
+
+    def __init__(self):
+        self.means = {}
+
+    def __call__(self, stream):
+        for key, value in stream.items():
+            if isinstance(value, numpy.ndarray) and len(value):
+                self.means[key] = value.mean()
+
+
+def cpu_seconds():
+    """User and system CPU time of the process in seconds, at microsecond resolution"""
+    if resource is None:
+        return time.clock()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_shape(directory, channels, arduinoType, samples, packets):
+    """Acquires packets stream packets of one shape and returns a dict of measurements"""
+    rate = 1000.0
+    simulated = [SimulatedChannel('packet_sent_time', 1, 'unsigned long', rate=None)]
+    for channel in range(channels):
+        simulated.append(SimulatedChannel('channel%i' % channel, channel + 2, arduinoType, rate=rate))
+    clock = SteppedClock()
+    controller = SimulatedController(simulated, trial_duration=1e9, clock=clock)
+    serial_port = TimedSerialPort(None, serial_device=SimulatedSerial(controller))
+    plan = StreamPlan(controller.stream_definition())
+
+    persistor = db.Persistor()
+    filename = os.path.join(directory, 'bench_%i_%s_%i' % (channels, arduinoType.replace(' ', '_'), samples))
+    session_group = persistor.create_database(filename, {'benchmark': 1})
+    persistor.create_trials({'trialNumber': db.Int}, {'iti': (1, db.Int)}, {'result': (1, db.Int)},
+                            session_group, '')
+    trial_group = persistor.add_trial(1, {'trialNumber': 1}, {'iti': (1, db.Int, 0)},
+                                      controller.stream_definition(), session_group, 'benchmark')
+    serial_port.start_trial({'iti': (1, db.Int, 0), 'trialNumber': (0, db.Int, 1)})
+    callback = Callback()
+
+    latencies = dict((stage, []) for stage in STAGES)
+    total_samples = 0
+    cpu_start = cpu_seconds()
+    start = time.time()
+    for packet in range(packets):
+        clock.now += samples / rate
+        io_before = serial_port.io_seconds
+        t0 = time.time()
+        stream = serial_port.request_stream(plan)
+        t1 = time.time()
+        persistor.insert_stream(stream, trial_group)
+        t2 = time.time()
+        callback(stream)
+        t3 = time.time()
+        io = serial_port.io_seconds - io_before
+        latencies['serial'].append(io)
+        latencies['decode'].append(t1 - t0 - io)
+        latencies['persist'].append(t2 - t1)
+        latencies['callback'].append(t3 - t2)
+        total_samples += sum(len(value) for value in stream.values() if isinstance(value, numpy.ndarray))
+    persistor.end_trial(trial_group)
+    elapsed = time.time() - start
+    cpu = cpu_seconds() - cpu_start
+    persistor.insert_event({'result': 1}, session_group)
+    persistor.close_database()
+
+    result = {
+        'packets/s': packets / elapsed,
+        'samples/s': total_samples / elapsed,
+        'cpu us/packet': cpu / packets * 1e6,
+        'MB written': os.path.getsize(filename + '.h5') / 1e6,
+    }
+    for stage in STAGES:
+        result[stage] = (numpy.percentile(latencies[stage], 50) * 1e3,
+                         numpy.percentile(latencies[stage], 99) * 1e3)
+    return result
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--packets', type='int', default=2000)
+    parser.add_option('--shapes', default='quick', help='quick or full')
+    options, args = parser.parse_args()
+    shapes = FULL_SHAPES if options.shapes == 'full' else QUICK_SHAPES
+
+    directory = tempfile.mkdtemp(prefix='voyeur_bench')
+    try:
+        print "%i packets per shape, latencies in ms (p50/p99)" % options.packets
+        header = "%-22s %10s %12s" % ('shape', 'packets/s', 'samples/s')
+        for stage in STAGES:
+            header += " %15s" % stage
+        header += " %14s %11s" % ('cpu us/packet', 'MB written')
+        print header
+        for channels, arduinoType, samples in shapes:
+            result = run_shape(directory, channels, arduinoType, samples, options.packets)
+            line = "%-22s %10.0f %12.0f" % ('%i x %s x %i' % (channels, arduinoType, samples),
+                                            result['packets/s'], result['samples/s'])
+            for stage in STAGES:
+                line += " %7.3f/%7.3f" % result[stage]
+            line += " %14.1f %11.2f" % (result['cpu us/packet'], result['MB written'])
+            print line
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
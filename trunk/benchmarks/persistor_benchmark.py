@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""
+Persistor write benchmark
+
+Writes the same synthetic session with several compression and layout settings and reports
+write throughput and file size for each.
+
+Usage:
+    python benchmarks/persistor_benchmark.py [--trials N] [--packets N] [--samples N] [--channels N]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import optparse
+
+import tables
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from voyeur import db
+
+
+SETTINGS = [
+    ('no compression', db.TRIAL_LAYOUT, tables.Filters(complevel=0)),
+    ('zlib 1 + shuffle', db.TRIAL_LAYOUT, tables.Filters(complevel=1, complib='zlib', shuffle=True)),
+    ('zlib 5 + shuffle', db.TRIAL_LAYOUT, tables.Filters(complevel=5, complib='zlib', shuffle=True)),
+    ('blosc:lz4 5 + shuffle', db.TRIAL_LAYOUT, tables.Filters(complevel=5, complib='blosc:lz4', shuffle=True)),
+    ('session, no compression', db.SESSION_LAYOUT, tables.Filters(complevel=0)),
+    ('session, zlib 5 + shuffle', db.SESSION_LAYOUT, tables.Filters(complevel=5, complib='zlib', shuffle=True)),
+    ('session, blosc:lz4 5 + shuffle', db.SESSION_LAYOUT, tables.Filters(complevel=5, complib='blosc:lz4', shuffle=True)),
+]
+
+
+def synthetic_stream(channels, samples, packet):
+    """A sniff-like int16 trace per channel and a packet counter"""
+    t = numpy.arange(samples) + packet * samples
+    stream = {'packet_sent_time': packet}
+    for channel in range(channels):
+        trace = 800 * numpy.sin(t / (20.0 + channel)) + numpy.random.normal(0, 10, samples)
+        stream['channel%i' % channel] = trace.astype(numpy.int16)
+    return stream
+
+
+def write_session(filename, layout, filters, trials, packets, samples, channels):
+    """Writes one synthetic session and returns (seconds, bytes of sample data)"""
+    stream_definition = {'packet_sent_time': (1, 'unsigned long', db.Int)}
+    for channel in range(channels):
+        stream_definition['channel%i' % channel] = (channel + 2, 'int', db.Int16Array)
+    streams = [synthetic_stream(channels, samples, packet) for packet in range(packets)]
+
+    if filters.complib and tables.which_lib_version(filters.complib.split(':')[0]) is None:
+        return None
+    persistor = db.Persistor(layout=layout, filters=filters)
+    start = time.time()
+    session_group = persistor.create_database(filename, {'benchmark': 1})
+    persistor.create_trials({'trialNumber': db.Int}, {'iti': (1, db.Int)}, {'result': (1, db.Int)},
+                            session_group, '')
+    for trial in range(trials):
+        trial_group = persistor.add_trial(trial, {'trialNumber': trial}, {'iti': (1, db.Int, 1000)}, stream_definition,
+                                          session_group, 'benchmark trial')
+        for stream in streams:
+            persistor.insert_stream(stream, trial_group)
+        persistor.end_trial(trial_group)
+        persistor.insert_event({'result': trial}, session_group)
+    persistor.close_database()
+    seconds = time.time() - start
+    data_bytes = trials * packets * channels * samples * 2
+    return seconds, data_bytes
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--trials', type='int', default=50)
+    parser.add_option('--packets', type='int', default=100)
+    parser.add_option('--samples', type='int', default=50, help='samples per channel and packet')
+    parser.add_option('--channels', type='int', default=2)
+    options, args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='voyeur_bench')
+    try:
+        print "%i trials x %i packets x %i channels x %i samples" % (options.trials, options.packets,
+                                                                  options.channels, options.samples)
+        print "%-32s %10s %10s %10s" % ('setting', 'MB/s', 'file MB', 'ratio')
+        for index, (name, layout, filters) in enumerate(SETTINGS):
+            filename = os.path.join(directory, 'bench%i' % index)
+            result = write_session(filename, layout, filters, options.trials, options.packets,
+                                   options.samples, options.channels)
+            if result is None:
+                print "%-32s %10s" % (name, 'unavailable')
+                continue
+            seconds, data_bytes = result
+            size = os.path.getsize(filename + '.h5')
+            print "%-32s %10.2f %10.2f %10.2f" % (name, data_bytes / seconds / 1e6, size / 1e6,
+                                                   float(data_bytes) / size)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
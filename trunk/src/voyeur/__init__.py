@@ -1,2 +1,5 @@
+import os
 from traits.etsconfig.etsconfig import ETSConfig
-ETSConfig.toolkit = 'qt4'
+# Qt unless the ETS_TOOLKIT environment variable selects the toolkit, e.g. 'null' for a headless Monitor
+if not os.environ.get('ETS_TOOLKIT'):
+    ETSConfig.toolkit = 'qt4'
@@ -1,19 +1,29 @@
 import os
+import re
 import time
 import struct
 import binascii
 import glob
 import db
 import platform
-from Queue import Queue
-from PyQt4.QtCore import QThread
-from numpy import array, int32, float32, append, ndarray, int16
+from Queue import Queue, Empty
+from collections import deque
+from numpy import array, int32, float32, append, ndarray, uint8, dtype, frombuffer, asarray
 from serial import Serial, SerialException
 from configobj import ConfigObj
 import voyeur.exceptions as ex
-
-
-class SerialCallThread(QThread):
+from voyeur.clock import monotonic, sleep_until
+from voyeur.eventloop import WorkerThread
+
+# Capability flags of the controller's reply to chr(96), see SerialPort.request_capabilities
+# push mode streaming, chr(93) and chr(94)
+CAPABILITY_PUSH = 1
+# sequence number and CRC-16 checksum in every binary stream header
+CAPABILITY_CHECKSUM = 2
+# stream packet retransmission, chr(95)
+CAPABILITY_RETRANSMIT = 4
+
+class SerialCallThread(WorkerThread):
         '''
         This thread serializes communication across a single serial port.
 
@@ -21,7 +31,7 @@ class SerialCallThread(QThread):
         '''
 
         def __init__(self, monitor=None, max_queue_size = 1, QObject_parent=None):
-            QThread.__init__(self, QObject_parent)
+            WorkerThread.__init__(self, QObject_parent)
             self.monitor = monitor
             self.output_queue = Queue(maxsize=max_queue_size)
 
@@ -29,6 +39,36 @@ class SerialCallThread(QThread):
             #print "Enqueuing: ", fn
             self.output_queue.put((fn, args, kwargs), block=True)
 
+        def enqueue_at(self, deadline, fn, *args, **kwargs):
+            """
+            Enqueues fn to run at monotonic time deadline (as soon as possible if None). The
+            thread sleeps until the deadline, which only holds up the calls to this port.
+            """
+            if deadline is None:
+                self.enqueue(fn, *args, **kwargs)
+            else:
+                self.enqueue(self._call_at, deadline, fn, args, kwargs)
+
+        def restarted(self):
+            """
+            Starts the thread unless it is running, and returns the running thread. The thread
+            ends when acquisition stops and a finished thread cannot be started again headless
+            (threading.Thread), so it is replaced by a new one taking over its queue.
+            """
+            if self.isRunning():
+                return self
+            thread = self
+            if self.isFinished():
+                thread = SerialCallThread(monitor=self.monitor)
+                thread.output_queue = self.output_queue
+            thread.start()
+            return thread
+
+        def _call_at(self, deadline, fn, args, kwargs):
+            if self.monitor.running:
+                sleep_until(deadline)
+            fn(*args, **kwargs)
+
         def run(self):
             try:
                 from Foundation import NSAutoreleasePool
@@ -42,33 +82,197 @@ class SerialCallThread(QThread):
                 print "items: ", self.output_queue.qsize()
                 print "Getting item from queue: ", time.clock()"""
 
-                (output_fn, args, kwargs) = self.output_queue.get(block=True, timeout=0.5) # block 0.5 seconds
+                try:
+                    (output_fn, args, kwargs) = self.output_queue.get(block=True, timeout=0.5) # block 0.5 seconds
+                except Empty:
+                    continue # idle, e.g. between trials in push mode
                 #print "Got item in queue: ", time.clock()
                 #print "queue function starting: ", time.clock()
                 output_fn(*args, **kwargs)
                 #print "queue function return: ", time.clock()
 
 
+class SerialFramer(object):
+    """
+    Framing layer over the receive side of a serial port.
+
+    Owns one preallocated receive buffer that is filled with bulk reads. Handshake header lines
+    and binary payloads are cut from the buffer incrementally; payloads are returned as zero-copy
+    memoryviews, valid until the next read. A header line preceded by stray bytes (e.g. the rest
+    of a corrupted payload) is resynchronised on the header's '*' delimited fields, so a
+    corrupted packet costs that packet and not the whole input buffer.
+    """
+
+    # One or more "<handshake>,<fields>*" packets of printable characters terminating a line
+    HEADER = re.compile(r'(\d,[\x20-\x29\x2b-\x7e]*\*)+\r?\n$')
+
+    def __init__(self, serial, size=65536):
+        self.serial = serial
+        self._buffer = bytearray(size)
+        self._start = 0
+        self._end = 0
+        # statistics
+        self.resyncs = 0
+        self.discarded_bytes = 0
+
+    def available(self):
+        """Number of received bytes not consumed yet"""
+        return self._end - self._start
+
+    def read_line(self):
+        """
+        Returns the next line, including its '\n'. Stray bytes in front of a handshake header are
+        discarded. Returns the bytes received so far if the port timeout expires first.
+        """
+        while True:
+            end = self._buffer.find('\n', self._start, self._end)
+            if end >= 0:
+                break
+            if not self._fill():
+                end = self._end - 1
+                break
+        line = str(self._buffer[self._start:end + 1])
+        self._start = end + 1
+        if line[:1].isdigit() and line[1:2] == ',':
+            return line
+        match = self.HEADER.search(line)
+        if match and match.start() > 0:
+            self.resyncs += 1
+            self.discarded_bytes += match.start()
+            line = line[match.start():]
+        return line
+
+    def read_bytes(self, num_bytes):
+        """
+        Returns a memoryview of the next num_bytes bytes, or None if the port timeout expires
+        first. The bytes of an incomplete packet are discarded.
+        """
+        while self.available() < num_bytes:
+            if not self._fill(num_bytes - self.available()):
+                self.discarded_bytes += self.available()
+                self._start = self._end
+                return None
+        view = memoryview(self._buffer)[self._start:self._start + num_bytes]
+        self._start += num_bytes
+        return view
+
+    def fill_available(self):
+        """Moves the bytes waiting in the port to the buffer, without blocking. Returns their number."""
+        waiting = self.serial.inWaiting()
+        if waiting:
+            self._fill(waiting)
+        return waiting
+
+    def packet_complete(self):
+        """
+        True if the buffer holds a complete packet: a header line and, after a handshake 6 stream
+        header, its binary payload. Does not read from the port.
+        """
+        end = self._buffer.find('\n', self._start, self._end)
+        if end < 0:
+            return False
+        line = str(self._buffer[self._start:end + 1])
+        if not (line[:1].isdigit() and line[1:2] == ','):
+            match = self.HEADER.search(line)
+            if match:
+                line = line[match.start():]
+        payload = 0
+        if line[:2] == '6,':
+            try:
+                bytes_per_stream, sequence, checksum = parse_stream_header(line.split('*')[0].split(','))
+                payload = sum(bytes_per_stream)
+            except (ValueError, IndexError):
+                pass # not a stream header, e.g. the protocol name
+        return self._end - (end + 1) >= payload
+
+    def reset(self):
+        """Discards all received bytes, including the ones waiting in the port"""
+        self._start = self._end = 0
+        self.serial.flushInput()
+
+    def _fill(self, wanted=1):
+        """Reads at least one byte (blocking up to the port timeout), and whatever else is waiting"""
+        wanted = max(wanted, self.serial.inWaiting())
+        self._reserve(wanted)
+        chunk = self.serial.read(wanted)
+        if not chunk:
+            return False
+        self._buffer[self._end:self._end + len(chunk)] = chunk
+        self._end += len(chunk)
+        return True
+
+    def _reserve(self, wanted):
+        """Makes room for wanted bytes after the unconsumed data"""
+        if self._end + wanted <= len(self._buffer):
+            return
+        pending = self._end - self._start
+        if pending + wanted > len(self._buffer):
+            # memoryviews handed out earlier keep referencing the old buffer
+            buffer = bytearray(max(2 * len(self._buffer), pending + wanted))
+            buffer[0:pending] = self._buffer[self._start:self._end]
+            self._buffer = buffer
+        else:
+            self._buffer[0:pending] = self._buffer[self._start:self._end]
+        self._start = 0
+        self._end = pending
+
+
 class SerialPort(object):
 
     # Make it equal to the buffer size of Arduino. Used to detect buffer overflows and packets missing
     NOLOSSTRANSMISSIONRATE = 0.7
-    # Absolute time in seconds (from start of python program) of the last received streaming data
+    # Monotonic host time in seconds of the last received streaming data
     lastStreamTime = 0
     # Keep the maximum time in seconds between streaming data transmissions from Arduino
     maxRate = 0
     # Keep a counter of packets that arrive later than NOLOSSTRANSMISSIONRATE, indicating buffer overflown in Arduino
     overflownpackets = 0
-
-    def __init__(self, configFile, board = 'board1', port='port1', send_trial_number = False):
+    # Stream packet sequence numbers wrap around at this value (Arduino unsigned int)
+    SEQUENCEMODULO = 65536
+    # Sequence number of the last stream packet carrying one, None until one was received
+    lastSequence = None
+    # Keep a counter of stream packets missing from the sequence numbers
+    lostpackets = 0
+    # Keep a counter of stream packets that failed the checksum or arrived incomplete
+    corruptpackets = 0
+    # Keep a counter of corrupt stream packets recovered by retransmission
+    retransmittedpackets = 0
+    # Retransmission requests per corrupt stream packet (0 disables retransmission) and per trial.
+    # Only packets with a sequence number can be retransmitted, and only in request mode.
+    retransmit_tries = 0
+    retransmit_budget = 20
+    # Optional voyeur.clock.ClockSync estimating the controller clock offset from stream packets
+    clock_sync = None
+    # True while the controller pushes stream packets without requests (see start_streaming)
+    streaming = False
+    # Monotonic host time the last start trial command was written at, see voyeur.clock.monotonic
+    start_time = None
+    # CAPABILITY_* flags reported by the controller, None until requested (see request_capabilities)
+    capabilities = None
+
+    def __init__(self, configFile, board = 'board1', port='port1', send_trial_number = False, serial_device = None):
         """Takes the string name of the serial port
         (e.g. "/dev/tty.usbserial","COM1") and a baud rate (bps) and
         connects to that port at that speed.
+
+        serial_device is an already open Serial-compatible object to use instead of the configured
+        port, e.g. a :class:`voyeur.simulator.SimulatedSerial`.
         """
         # Flag for denoting wether to send trial number to Arduino. This depends on protocol and if the trial number is used
         # or further forwarded from Arduino to an acquisition device
         self.send_trial_number = send_trial_number
+        # Stream packets that arrived while waiting for a command reply in push mode, as (data, eot)
+        self._pushed = deque()
+        # Stream definition while the controller pushes stream packets, None in request mode
+        self._stream_def = None
+        self._trial_counts = (0, 0, 0)
+        self._trial_frame = None
+        self._retransmits_left = self.retransmit_budget
         self.config = ConfigObj(configFile)
+        if serial_device is not None:
+            self.serial = serial_device
+            self.framer = SerialFramer(self.serial)
+            return
         self.os = self.config['platform']['os']
         serial = self.config['serial']
         baudrate = serial['baudrate']
@@ -78,37 +282,31 @@ class SerialPort(object):
             self.serial = Serial(serialport, baudrate, timeout=1)
         else:
             raise ex.SerialException(serialport, "Serial Port Incorrect. Check config file.")
+        self.framer = SerialFramer(self.serial)
 
     def read_line(self):
         """Reads the serial buffer"""
         line = None
         try:
-            line = self.serial.readline()
+            line = self.framer.read_line()
         except SerialException as e:
             print('pySerial exception: Exception that is raised on write timeouts')
             print(e)
         return line
 
-    def read_byte_streams(self, num_bytes,tries=8):
-        count = 0
-        while self.serial.inWaiting() != num_bytes and count < tries: #wait until number of bytes in recieve buffer is equal to expected number of bytes.
-            # Reading the serial stream is part of the separate serial acquisition thread and will not break or make the UI lag
-            if tries <= 8:
-                time.sleep(0.01+.01*count**2)# blocks for 1 second, with exponentially increasing checks.(10ms,20ms,50ms,100ms...)
-            else:    # If tries was higher than 8, wait the minimum set time of 10ms
-                time.sleep(0.01)
-            count += 1
-            
-        if self.serial.inWaiting() == num_bytes: # when buffer is ready, read and return.
-            bytestream = self.serial.read(num_bytes)
-            if len(bytestream) == num_bytes:
-                return bytestream
-        # TODO: Take partially transmitted data but warn of data loss?? Implement a retry protocol?
-        else: # if buffer never fills to expected value, do not read the packet, instead flush the incoming serial of partial packet and return.
-            self.serial.flushInput()
-            print 'ERROR in serial stream acquisition: not enough bytes transmitted by arduino'
-            return None
+    def read_byte_streams(self, num_bytes):
+        """
+        Reads num_bytes of binary stream data.
 
+        Returns a zero-copy memoryview of the receive buffer, valid until the next read, or None
+        if the bytes do not arrive before the port timeout expires. Bytes that already arrived for
+        the next packet stay buffered.
+        """
+        # Reading the serial stream is part of the separate serial acquisition thread and will not break or make the UI lag
+        bytestream = self.framer.read_bytes(num_bytes)
+        if bytestream is None:
+            print 'ERROR in serial stream acquisition: not enough bytes transmitted by arduino'
+        return bytestream
 
     def write(self, data):
         """Writes *data* string to serial"""
@@ -120,46 +318,225 @@ class SerialPort(object):
         for i in range(tries):
             #print "try: ", i
             self.write(chr(87))
-            packets = self.read_line()
-            
-            # Collect statistics about the transmission rate and lost packets
-            streamtime = time.clock()
-            rate = streamtime - self.lastStreamTime
-            #print "Stream received: ", rate            
-            # Skip the first measurement as that depends on when the user starts the streaming and
-            #  the first transmission will for sure overflow the buffer
-            if self.lastStreamTime > 0:
-                if rate > self.maxRate:
-                    self.maxRate = rate
-                if rate > self.NOLOSSTRANSMISSIONRATE:
-                    self.overflownpackets += 1
-            self.lastStreamTime = streamtime
-            #print "Stream returned: ", packets, " time: ", time.clock()
-            return parse_serial(packets, stream_def, self)
+            return self._read_packet(stream_def)
+
+    def fileno(self):
+        """File descriptor of the port for select(), None if the port has none (e.g. on Windows)"""
+        try:
+            return self.serial.fileno()
+        except (AttributeError, ValueError, OSError):
+            return None
+
+    def send_stream_request(self):
+        """Requests a stream packet, to be read with read_stream()"""
+        self.write(chr(87))
+
+    def stream_arrived(self):
+        """
+        True if read_stream() can return a packet without waiting for the port: a complete packet
+        has been received, or a stream packet was set aside while reading a command reply.
+        """
+        if self._pushed:
+            return True
+        self.framer.fill_available()
+        return self.framer.packet_complete()
+
+    def read_stream(self, stream_def):
+        """
+        Reads the next stream packet, without requesting it.
+
+        In push mode (see start_streaming) this is how packets are acquired. Returns an empty
+        dictionary if the controller is not streaming.
+        """
+        if self._pushed:
+            data, eot = self._pushed.popleft()
+            if eot:
+                exp = ex.EndOfTrialException('End of trial')
+                exp.last_read = data
+                raise exp
+            return data
+        if self._stream_def is not None and not self.streaming:
+            # push mode trial ended
+            return {}
+        return self._read_packet(stream_def)
+
+    def _read_packet(self, stream_def):
+        """Reads and parses the next stream packet"""
+        packets = self.read_line()
+
+        # Collect statistics about the transmission rate and lost packets
+        streamtime = monotonic()
+        rate = streamtime - self.lastStreamTime
+        #print "Stream received: ", rate            
+        # Skip the first measurement as that depends on when the user starts the streaming and
+        #  the first transmission will for sure overflow the buffer
+        if self.lastStreamTime > 0:
+            if rate > self.maxRate:
+                self.maxRate = rate
+            if rate > self.NOLOSSTRANSMISSIONRATE:
+                self.overflownpackets += 1
+        self.lastStreamTime = streamtime
+        #print "Stream returned: ", packets, " time: ", time.clock()
+        try:
+            return self._parse_stream(packets, stream_def, streamtime)
+        except ex.EndOfTrialException:
+            # the controller stops pushing at the end of a trial
+            self.streaming = False
+            raise
+
+    def _parse_stream(self, packets, stream_def, received):
+        """
+        Parses a stream packet and stamps it with received, its monotonic host receive time.
+        The controller clock offset estimate is updated if clock_sync is set.
+        """
+        try:
+            data = parse_serial(packets, stream_def, self)
+        except ex.EndOfTrialException as e:
+            self._stamp(e.last_read, received)
+            raise
+        self._stamp(data, received)
+        return data
+
+    def _stamp(self, data, received):
+        if data:
+            data[db.HOST_TIME] = received
+            if self.clock_sync is not None:
+                self.clock_sync.update_from_stream(data, received)
+
+    def start_streaming(self, stream_def, interval_ms=0):
+        """
+        Switches the controller to push mode: after a single chr(93) command it sends stream
+        packets every interval_ms milliseconds (0 for the controller's default) until the end of
+        the trial, end_trial() or stop_streaming(). Read the packets with read_stream().
+
+        Raises SerialException if the controller does not support push mode.
+        """
+        self.require(CAPABILITY_PUSH, 'push mode streaming')
+        self._stream_def = stream_def
+        self._pushed.clear()
+        self.lastSequence = None
+        self.streaming = True
+        self.write(chr(93) + pack_integer('H', interval_ms))
+
+    def stop_streaming(self):
+        """Stops push mode streaming"""
+        if self.streaming:
+            self.write(chr(94))
+            line = self._read_reply()
+            self.streaming = False
+            self._stream_def = None
+            return bool(line) and line[:1] == '2'
+        self._stream_def = None
+        return True
+
+    def check_sequence(self, sequence):
+        """Counts the stream packets missing before the packet with sequence number sequence"""
+        if self.lastSequence is not None:
+            self.lostpackets += (sequence - self.lastSequence - 1) % self.SEQUENCEMODULO
+        self.lastSequence = sequence
+
+    def stream_corrupt(self, sequence, bytes_per_stream):
+        """
+        Counts a stream packet that failed the checksum or arrived incomplete, and requests
+        it again with chr(95) if retransmission is enabled.
+
+        Returns the bytes of the retransmitted packet or None if it could not be recovered.
+        """
+        self.corruptpackets += 1
+        if sequence is None or self.streaming:
+            return None
+        tries = min(self.retransmit_tries, self._retransmits_left)
+        for i in range(tries):
+            self._retransmits_left -= 1
+            self.write(chr(95) + pack_integer('H', sequence))
+            line = self.read_line()
+            if not line or line[:2] != '6,':
+                continue
+            try:
+                resent_bytes, resent_sequence, checksum = parse_stream_header(line.split('*')[0].split(','))
+            except (ValueError, IndexError):
+                continue
+            if resent_sequence != sequence or resent_bytes != bytes_per_stream:
+                continue
+            bytestream = self.framer.read_bytes(sum(bytes_per_stream))
+            if verify_stream(bytestream, checksum):
+                self.retransmittedpackets += 1
+                return bytestream
+        return None
+
+    def reset_trial_statistics(self):
+        """Starts counting trial_statistics() and the retransmit budget anew"""
+        self._trial_counts = (self.lostpackets, self.corruptpackets, self.retransmittedpackets)
+        self._retransmits_left = self.retransmit_budget
+        self.lastSequence = None
+
+    def trial_statistics(self):
+        """Counts of lost, corrupt and retransmitted stream packets since the last start_trial"""
+        lost, corrupt, retransmitted = self._trial_counts
+        statistics = {'lostPackets': self.lostpackets - lost,
+                      'corruptPackets': self.corruptpackets - corrupt,
+                      'retransmittedPackets': self.retransmittedpackets - retransmitted}
+        if self.clock_sync is not None and self.clock_sync.offset is not None:
+            # host monotonic time (s) = controller time (ms) / 1000 + clockOffset
+            statistics['clockOffset'] = self.clock_sync.offset
+        return statistics
+
+    def _read_reply(self):
+        """
+        Reads the reply to a command. In push mode, stream packets arriving before the reply are
+        decoded and kept for read_stream().
+        """
+        line = self.read_line()
+        while self.streaming and line and line[:2] == '6,':
+            try:
+                self._pushed.append((self._parse_stream(line, self._stream_def, monotonic()), False))
+            except ex.EndOfTrialException as e:
+                self._pushed.append((e.last_read, True))
+                self.streaming = False
+            line = self.read_line()
+        return line
 
     def request_event(self, event_def, tries=10):
         """Reads event data"""
         for i in range(tries):
             self.write(chr(88))
             packets = self.read_line()
+            received = monotonic()
             #print packets
-            return parse_serial(packets, event_def, self)
+            event = parse_serial(packets, event_def, self)
+            if event:
+                event[db.HOST_TIME] = received
+            return event
 
-    def start_trial(self, parameters, tries=10):
-        """Sends start command"""
-        params = convert_format(parameters)
-         # trial number is needed for some protocols which send the trial parameter to Arduino
-         # Arduino can make use of this or send it via serial to an acquisition device.
-        if not self.send_trial_number:
-            params.pop("trialNumber")
-        values = params.values()
-        values.sort()
+    def trial_command(self, parameters):
+        """
+        Packs the start trial command for the controller parameters.
+
+        The frame is compiled once and reused while the parameter definition stays the same,
+        so the command can be packed ahead of time, e.g. during the inter-trial interval.
+        """
+        if self._trial_frame is None or not self._trial_frame.matches(parameters):
+            self._trial_frame = TrialFrame(parameters, self.send_trial_number)
+        return self._trial_frame.pack(parameters)
+
+    def start_trial(self, parameters, tries=10, command=None):
+        """
+        Sends start command
+
+        command is the start trial command packed by trial_command(parameters). It is packed
+        here if not given.
+        """
+        if self.retransmit_tries:
+            self.require(CAPABILITY_RETRANSMIT, 'stream packet retransmission')
+        self.reset_trial_statistics()
+        # request mode unless start_streaming follows
+        self._stream_def = None
+        if command is None:
+            command = self.trial_command(parameters)
         #print "Starting trial..."
         for i in range(tries):
-            self.write(chr(90))
-            for index, format, value in values:
-                #print value
-                self.write(pack_integer(format, value))
+            self.start_time = monotonic()
+            self.write(command)
             line = self.read_line()
             #print line
             if line and int(line[:1]) == 2:
@@ -173,7 +550,7 @@ class SerialPort(object):
             self.write(chr(86))
             self.write(command)
             self.write("\r")
-            line = self.read_line()
+            line = self._read_reply()
             print line
             if line and int(line[:1]) == 2:
                 return True
@@ -182,10 +559,13 @@ class SerialPort(object):
         """Sends end command"""
         for i in range(tries):
             self.write(chr(89))
-            line = self.read_line()
+            line = self._read_reply()
+            self.streaming = False
+            self._stream_def = None
             #print line
             print "Maximum intertransmission rate(ms): ", self.maxRate
             print "Number of transmissions slower than max rate: ", self.overflownpackets
+            print "Stream packets lost / corrupt / retransmitted: ", self.lostpackets, self.corruptpackets, self.retransmittedpackets
             if line and int(line[:1]) == 3:
                 return True
 
@@ -198,6 +578,42 @@ class SerialPort(object):
                 values = line.split(',')
                 return values[1]
 
+    def request_capabilities(self, tries=1):
+        """
+        Asks the controller which protocol extensions it supports with chr(96).
+
+        The controller replies 7,<flags>,* with the sum of the CAPABILITY_* flags it supports.
+        Controller code without the request (e.g. controller_ser) ignores it and does not reply,
+        which is taken as no extensions after the port timeout. Returns the flags and keeps them
+        in capabilities.
+
+        Only needed for the extensions, so it is sent by supports() when one of them is used.
+        chr(92) is not available for this: controller_ser forces a pin with it.
+        """
+        self.capabilities = 0
+        for i in range(tries):
+            self.write(chr(96))
+            line = self.read_line()
+            if line and line[:2] == '7,':
+                try:
+                    self.capabilities = int(line.split(',')[1])
+                except (ValueError, IndexError):
+                    continue
+                break
+        return self.capabilities
+
+    def supports(self, capability):
+        """True if the controller reported the CAPABILITY_* flag capability, requested once"""
+        if self.capabilities is None:
+            self.request_capabilities()
+        return bool(self.capabilities & capability)
+
+    def require(self, capability, feature):
+        """Raises SerialException naming feature if the controller does not support capability"""
+        if not self.supports(capability):
+            raise ex.SerialException(getattr(self.serial, 'name', ''),
+                                     "Controller does not support " + feature + ". Check the controller code version.")
+
     def upload_code(self, hex_path):
         """Upload code to the arduino"""
         self.serial.close()
@@ -214,18 +630,47 @@ class SerialPort(object):
                             + " -Uflash:w:" + hex_path + ":i"
         os.system(arduino_upload_cmd)
         self.serial.open()
+        # the new code may support other extensions
+        self.capabilities = None
 
     def open(self):
         """Open the serial connection"""
         self.serial.open()
+        self.framer.reset()
 
     def close(self):
         """Close the serial connection"""
         self.serial.close()
 
+def configured_boards(configFile):
+    """
+    Returns the [(board, port)] pairs of the controller boards configured for this platform,
+    ordered by board number: every boardN in [platform] with a portN in [serial][[<os>]].
+    """
+    config = ConfigObj(configFile)
+    try:
+        ports = config['serial'][config['platform']['os']]
+    except KeyError:
+        return []
+    boards = []
+    for name in config['platform']:
+        match = re.match(r'board(\d+)$', name)
+        if match and 'port' + match.group(1) in ports:
+            boards.append((int(match.group(1)), name, 'port' + match.group(1)))
+    return [(name, port) for number, name, port in sorted(boards)]
+
+
 def parse_serial(packets, protocol_def, serial_obj):
-    """Parse serial read"""
+    """Parse serial read
+
+    protocol_def is either a definition dictionary or a :class:`StreamPlan` compiled from one.
+    """
     data = {}
+    if isinstance(protocol_def, StreamPlan):
+        plan = protocol_def
+        protocol_def = plan.definition
+    else:
+        plan = None
     eot = False
     #print protocol_def
     #print packets
@@ -233,7 +678,11 @@ def parse_serial(packets, protocol_def, serial_obj):
         for packet in packets.split('*'):
             if packet and packet != '\r\n':
                 payload = packet.split(',')
-                handshake = int(payload[0])
+                try:
+                    handshake = int(payload[0])
+                except ValueError:
+                    print 'Skipping malformed packet: ', repr(packet)
+                    continue
                 #print "handshake:", handshake
                 if handshake == 1:
                     if protocol_def:
@@ -252,73 +701,24 @@ def parse_serial(packets, protocol_def, serial_obj):
                 elif handshake == 5:
                     eot = True
                 elif handshake == 6:
-                    bytes_per_stream = [];
-                    num_streams = int(payload.pop(1)) #read and discard this value to maintain consistency with the stream_definition numbering.
-                    if len(payload) < num_streams + 1:
-                        print "oh shit, you don't have enough stream length specifiers"
-                    for stream_number in range(num_streams):
-                        bytes_per_stream.append(int(payload[1+stream_number]))
+                    bytes_per_stream, sequence, checksum = parse_stream_header(payload)
+                    if sequence is not None and hasattr(serial_obj, 'check_sequence'):
+                        serial_obj.check_sequence(sequence)
                     bytes_to_read = sum(bytes_per_stream)
                     bytestream = serial_obj.read_byte_streams(bytes_to_read)
+                    if not verify_stream(bytestream, checksum):
+                        bytestream = None
+                        if hasattr(serial_obj, 'stream_corrupt'):
+                            bytestream = serial_obj.stream_corrupt(sequence, bytes_per_stream)
+                    if plan is None:
+                        plan = StreamPlan(protocol_def)
                     
-                    if bytestream == None: # failure, no streams recieved,
-                        for key, (index, arduinoType, kind) in protocol_def.items():
+                    if bytestream is None: # failure, no streams recieved,
+                        for key in plan.keys:
                             data[key] = None
                         print 'Lost packet: no data received'
-                    
-                    byte_index_start = 0
-                    
-                    for key, (index, arduinoType, kind) in protocol_def.items():
-                        #data[key] =  convert_type(kind, payload[index])
-                        if bytes_per_stream[index-1] == 0: # expecting empty stream, so set output to None.
-                            data[key] = None
-                            continue
-                        
-                        byte_index_start = sum(bytes_per_stream[:(index-1)])
-                        byte_index_end = sum(bytes_per_stream[:(index)])
-                        stream_bytes = bytestream[byte_index_start:byte_index_end]
-                        unpacked_stream =[]
-                        
-                        ## unpack the bytes into integers based on the type specified in the stream_definition.
-                        if arduinoType == 'int': # h for short integers
-                            num_vals = len(stream_bytes)/2
-                            t = "<%ih" % (num_vals) # little-endian,number of integers,signed int
-                            vals = struct.unpack(t,stream_bytes)
-                            unpacked_stream = array(vals,dtype = int16)
-                                
-                        elif arduinoType == 'unsigned int': #H 
-                            num_vals = len(stream_bytes)/2
-                            t = "<%iH" % (num_vals) # little-endian(<),number of integers,unsigned int (H)
-                            vals = struct.unpack(t,stream_bytes)
-                            unpacked_stream = list(vals)
-                            
-                        elif arduinoType == 'long': # i
-                            num_vals = len(stream_bytes)/4
-                            t = "<%ii" % (num_vals) # little-endian(<),number of integers,unsigned int (i)
-                            vals = struct.unpack(t,stream_bytes)
-                            unpacked_stream = list(vals)
-                                
-                        elif arduinoType == 'unsigned long': #I
-                            num_vals = len(stream_bytes)/4
-                            t = "<%iI" % (num_vals) # little-endian(<),number of integers,unsigned int (H)
-                            vals = struct.unpack(t,stream_bytes)   
-                            unpacked_stream = list(vals)                            
-                        
-                        if type(kind) != type(db.Int): 
-                            if type(kind) == ndarray:
-                                if kind.dtype == int16:
-                                    unpacked_stream = append(db.Int16Array, unpacked_stream)
-                                elif kind.dtype == float32:
-                                    unpacked_stream = [float(i) for i in unpacked_stream]
-                                    unpacked_stream = append(db.FloatArray, unpacked_stream)
-                                elif kind.dtype == int32:
-                                    unpacked_stream = append(db.IntArray, unpacked_stream)
-                                
-                        
-                        elif len(unpacked_stream) == 1:
-                            unpacked_stream = int(unpacked_stream[0])
-                                
-                        data[key] = unpacked_stream;         
+                    else:
+                        data.update(plan.decode(bytes_per_stream, bytestream))
         if eot:
             exp = ex.EndOfTrialException('End of trial')
             exp.last_read = data
@@ -326,6 +726,171 @@ def parse_serial(packets, protocol_def, serial_obj):
     return data
 
 
+def parse_stream_header(payload):
+    """
+    Parses the fields of a handshake 6 header, 6,<streams>,<bytes 1>,...,<bytes n>[,<sequence>[,<checksum>]]
+
+    Returns (bytes_per_stream, sequence, checksum). Sequence and checksum are None if the
+    controller did not send them.
+    """
+    num_streams = int(payload[1])
+    if len(payload) < num_streams + 2:
+        print "oh shit, you don't have enough stream length specifiers"
+    bytes_per_stream = [int(field) for field in payload[2:2 + num_streams]]
+    trailer = [int(field) for field in payload[2 + num_streams:] if field.strip() != '']
+    trailer += [None, None]
+    return bytes_per_stream, trailer[0], trailer[1]
+
+
+def verify_stream(bytestream, checksum):
+    """
+    Checks the bytes of a binary stream packet against the checksum of its header, a CRC-16/XMODEM
+    (Arduino util/crc16.h _crc_xmodem_update starting from 0). Packets without checksum only need
+    to be complete.
+    """
+    if bytestream is None:
+        return False
+    return checksum is None or binascii.crc_hqx(bytestream, 0) == checksum
+
+
+# Little-endian numpy dtypes of the Arduino types used in binary (handshake 6) streams.
+STREAM_DTYPES = {
+    'int': dtype('<i2'),
+    'unsigned int': dtype('<u2'),
+    'long': dtype('<i4'),
+    'unsigned long': dtype('<u4'),
+}
+
+
+class TrialFrame(object):
+    """
+    Compiled start trial command (chr(90) followed by the packed controller parameters) for
+    one {name => (index, kind, value)} controller parameter definition.
+
+    Parameters are packed in index order with a single struct.Struct, using the same native
+    byte order and sizes and no padding, like separate pack_integer calls. Reuse a frame
+    until :meth:`matches` reports that the definition changed.
+    """
+
+    def __init__(self, parameters, send_trial_number=False):
+        self.signature = TrialFrame.definition_signature(parameters)
+        params = convert_format(parameters)
+         # trial number is needed for some protocols which send the trial parameter to Arduino
+         # Arduino can make use of this or send it via serial to an acquisition device.
+        if not send_trial_number:
+            params.pop("trialNumber")
+        entries = sorted((index, format, key) for key, (index, format, value) in params.items())
+        self.keys = [key for index, format, key in entries]
+        self.struct = struct.Struct('=c' + ''.join(format for index, format, key in entries))
+
+    @staticmethod
+    def definition_signature(parameters):
+        """Hashable description of the parameter names, indices and types, ignoring the values"""
+        return tuple(sorted((key, index, type(kind).__name__) for key, (index, kind, value) in parameters.items()))
+
+    def matches(self, parameters):
+        """True if this frame was compiled from an equivalent parameter definition"""
+        return self.signature == TrialFrame.definition_signature(parameters)
+
+    def pack(self, parameters):
+        """Packs the start trial command with the parameter values"""
+        return self.struct.pack(chr(90), *[parameters[key][2] for key in self.keys])
+
+
+class StreamPlan(object):
+    """
+    Compiled form of a binary (handshake 6) stream definition.
+
+    The type dispatch on each {name => (index, arduinoType, kind)} entry is done once, when
+    the plan is built, so decoding a packet is a single pass over the prefix-summed byte
+    offsets of its streams. Build a plan once per stream_definition() and reuse it until
+    :meth:`matches` reports that the definition changed.
+
+    Decoded streams have the shape parse_serial always gave them: other kinds than the array kinds
+    are decoded as lists, except 'int' streams (numpy int16 arrays). With arrays set they are
+    decoded as numpy arrays of the wire type, which saves a conversion per packet for protocols
+    that do not use list operations on stream values.
+    """
+
+    def __init__(self, stream_definition, arrays=False):
+        self.definition = stream_definition
+        self.arrays = arrays
+        self.signature = StreamPlan.definition_signature(stream_definition)
+        entries = sorted((stream_definition or {}).items(), key=lambda item: item[1][0])
+        # key order of the decoded streams, ordered by stream index
+        self.keys = [key for key, definition in entries]
+        # (key, position in the byte counts, wire dtype, target dtype, scalar) per binary stream
+        self.channels = []
+        for key, definition in entries:
+            if len(definition) != 3: # ASCII (handshake 1) stream definition, nothing to compile
+                continue
+            index, arduinoType, kind = definition
+            target = None
+            scalar = False
+            if type(kind) == ndarray:
+                target = kind.dtype
+            elif type(kind) == type(db.Int):
+                scalar = True
+            self.channels.append((key, index - 1, STREAM_DTYPES[arduinoType], target, scalar))
+
+    @staticmethod
+    def definition_signature(stream_definition):
+        """Hashable description of a stream definition, used to detect definition changes"""
+        signature = []
+        for key, definition in (stream_definition or {}).items():
+            entry = [key]
+            for value in definition:
+                if type(value) == ndarray:
+                    entry.append(value.dtype.str)
+                elif isinstance(value, (int, str)):
+                    entry.append(value)
+                else:
+                    entry.append(type(value).__name__)
+            signature.append(tuple(entry))
+        return tuple(sorted(signature))
+
+    def matches(self, stream_definition):
+        """True if this plan was compiled from an equivalent stream definition"""
+        return self.signature == StreamPlan.definition_signature(stream_definition)
+
+    def decode(self, bytes_per_stream, bytestream):
+        """
+        Decodes the bytestream (str or memoryview) of one packet into a {name => value} dictionary.
+
+        Each stream's bytes are viewed in place as a typed array, without intermediate copies.
+        Array kinds (db.IntArray, db.FloatArray, db.Int16Array) are returned as new arrays of
+        the kind's dtype, db.Int returns an int when the stream holds a single value and other
+        streams are returned as lists or arrays (see :class:`StreamPlan`).
+        """
+        offsets = [0]
+        for num_bytes in bytes_per_stream:
+            offsets.append(offsets[-1] + num_bytes)
+        if isinstance(bytestream, memoryview):
+            raw = asarray(bytestream)
+        else:
+            raw = frombuffer(bytestream, dtype=uint8)
+
+        data = {}
+        for key, position, stream_dtype, target, scalar in self.channels:
+            num_bytes = bytes_per_stream[position]
+            if num_bytes == 0: # expecting empty stream, so set output to None.
+                data[key] = None
+                continue
+            count = num_bytes // stream_dtype.itemsize
+            start = offsets[position]
+            values = raw[start:start + count * stream_dtype.itemsize].view(stream_dtype)
+            if target is not None:
+                # astype copies, so the returned array does not hold a reference to the serial buffer
+                data[key] = values.astype(target)
+            elif scalar and count == 1:
+                data[key] = int(values[0])
+            elif self.arrays or stream_dtype == STREAM_DTYPES['int']:
+                data[key] = values.copy()
+            else:
+                data[key] = values.tolist()
+        return data
+
+
 def convert_format(parameters):
     """Converts dictionary database type format to serial transmission format"""
     values = parameters.copy()
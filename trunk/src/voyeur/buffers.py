@@ -0,0 +1,133 @@
+import threading
+from collections import deque
+from numpy import ndarray, concatenate
+from voyeur.db import BOARD
+
+"""Thread handoff buffers"""
+
+# Backpressure policies of HandoffBuffer
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+COALESCE = 'coalesce'
+POLICIES = (BLOCK, DROP_OLDEST, COALESCE)
+
+
+class HandoffBuffer(object):
+    """
+    Bounded buffer handing items from a producer thread to a consumer thread.
+
+    Producer and consumer wait on a condition variable, never by spinning. When the buffer
+    is full, put() applies the backpressure policy:
+
+        block       -- wait until the consumer takes an item (or abort() returns True)
+        drop_oldest -- discard the oldest buffered item
+        coalesce    -- merge the new item into the newest buffered item with coalesce(old, new).
+                       If coalesce returns None the items cannot be merged and put() blocks.
+    """
+
+    def __init__(self, maxsize=1, policy=BLOCK, coalesce=None):
+        if policy not in POLICIES:
+            raise ValueError("Unknown backpressure policy: %s" % policy)
+        self.maxsize = max(1, maxsize)
+        self.policy = policy
+        self.coalesce = coalesce or merge_streams
+        self.dropped = 0
+        self.coalesced = 0
+        self._items = deque()
+        self._condition = threading.Condition()
+        self._closed = False
+
+    def put(self, item, abort=None):
+        """
+        Adds item to the buffer.
+
+        abort is an optional callable checked whenever a blocked put() is woken up (see wake()).
+        When it returns True the item is added even though the buffer is full, so a blocked
+        producer never holds on to data.
+        """
+        with self._condition:
+            if len(self._items) >= self.maxsize:
+                if self.policy == DROP_OLDEST:
+                    self._items.popleft()
+                    self.dropped += 1
+                elif self.policy == COALESCE:
+                    merged = self.coalesce(self._items[-1], item)
+                    if merged is not None:
+                        self._items[-1] = merged
+                        self.coalesced += 1
+                        self._condition.notify_all()
+                        return
+                while len(self._items) >= self.maxsize and not self._closed:
+                    if abort is not None and abort():
+                        break
+                    self._condition.wait()
+            self._items.append(item)
+            self._condition.notify_all()
+
+    def get(self, block=True, timeout=None):
+        """Removes and returns the oldest item. Returns None if no item is available."""
+        with self._condition:
+            if block:
+                if timeout is None:
+                    while not self._items and not self._closed:
+                        self._condition.wait()
+                elif not self._items:
+                    self._condition.wait(timeout)
+            if not self._items:
+                return None
+            item = self._items.popleft()
+            self._condition.notify_all()
+            return item
+
+    def get_all(self):
+        """Removes and returns all buffered items, oldest first, without blocking"""
+        with self._condition:
+            items = list(self._items)
+            self._items.clear()
+            self._condition.notify_all()
+            return items
+
+    def wake(self):
+        """Wakes up blocked producers and consumers so they re-check their abort conditions"""
+        with self._condition:
+            self._condition.notify_all()
+
+    def close(self):
+        """Releases all blocked threads. Puts no longer block once the buffer is closed."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def open(self):
+        """Reopens a closed buffer"""
+        with self._condition:
+            self._closed = False
+
+    def clear(self):
+        """Discards all buffered items"""
+        self.get_all()
+
+    def __len__(self):
+        with self._condition:
+            return len(self._items)
+
+
+def merge_streams(old, new):
+    """
+    Merges two stream dictionaries into one.
+
+    Array values are concatenated, other values are taken from the newer stream unless it is None.
+    Streams of different controller boards are not merged (returns None).
+    """
+    if old.get(BOARD) != new.get(BOARD):
+        return None
+    merged = dict(old)
+    for key, value in new.items():
+        previous = merged.get(key)
+        if value is None:
+            continue
+        elif type(value) == ndarray and type(previous) == ndarray:
+            merged[key] = concatenate((previous, value))
+        else:
+            merged[key] = value
+    return merged
@@ -0,0 +1,115 @@
+import sys
+import time
+import ctypes
+import ctypes.util
+from collections import deque
+
+"""Monotonic host clock and controller clock alignment"""
+
+
+def _monotonic_function():
+    """
+    Returns the best available monotonic, high-resolution clock in seconds.
+
+    time.monotonic where available, else clock_gettime(CLOCK_MONOTONIC) on Linux and OS X and
+    QueryPerformanceCounter on Windows. Falls back to time.time, which is not monotonic.
+    """
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+
+    if sys.platform == 'win32':
+        try:
+            kernel32 = ctypes.windll.kernel32
+            frequency = ctypes.c_int64()
+            kernel32.QueryPerformanceFrequency(ctypes.byref(frequency))
+            scale = 1.0 / frequency.value
+            def monotonic():
+                counter = ctypes.c_int64()
+                kernel32.QueryPerformanceCounter(ctypes.byref(counter))
+                return counter.value * scale
+            return monotonic
+        except (AttributeError, OSError, ZeroDivisionError):
+            return time.time
+
+    # CLOCK_MONOTONIC
+    clock_id = 6 if sys.platform == 'darwin' else 1
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    for name in ('c', 'rt'):
+        path = ctypes.util.find_library(name)
+        if path is None:
+            continue
+        try:
+            clock_gettime = ctypes.CDLL(path, use_errno=True).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        clock_gettime.restype = ctypes.c_int
+        if clock_gettime(clock_id, ctypes.byref(timespec())) != 0:
+            continue
+        def monotonic():
+            # a timespec per call: ctypes releases the GIL, so threads calling at once would share one
+            now = timespec()
+            clock_gettime(clock_id, ctypes.byref(now))
+            return now.tv_sec + now.tv_nsec * 1e-9
+        return monotonic
+    return time.time
+
+# Seconds from an arbitrary, fixed point in time. Only differences are meaningful.
+monotonic = _monotonic_function()
+
+
+def sleep_until(deadline, spin=0.002):
+    """
+    Returns at monotonic time deadline. Sleeps until spin seconds before it, then polls the
+    clock, as sleep() may oversleep by a scheduler tick.
+    """
+    remaining = deadline - monotonic()
+    if remaining > spin:
+        time.sleep(remaining - spin)
+    while monotonic() < deadline:
+        pass
+
+
+class ClockSync(object):
+    """
+    Estimates the offset between the controller clock and the host monotonic clock.
+
+    Every stream packet carrying a controller timestamp (in ms, e.g. a packet_sent_time stream)
+    gives an upper bound of the offset: host receive time - controller send time is the offset
+    plus the transmission delay. The smallest difference over the last window packets is the
+    estimate, so only the fastest transmissions count and the estimate follows drift.
+
+    Attributes:
+        stream -- name of the scalar stream holding the controller time in ms
+        window -- number of packets the estimate is taken over
+    """
+
+    def __init__(self, stream='packet_sent_time', window=200):
+        self.stream = stream
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        """Forgets all measurements"""
+        self._differences = deque(maxlen=self.window)
+        self.offset = None
+
+    def update(self, controller_ms, host_time):
+        """Adds a packet sent at controller_ms (controller clock) and received at host_time (monotonic)"""
+        self._differences.append(host_time - controller_ms / 1000.0)
+        self.offset = min(self._differences)
+
+    def update_from_stream(self, stream, host_time):
+        """Adds a decoded stream packet if it holds the controller time"""
+        controller_ms = stream.get(self.stream)
+        if controller_ms is not None and not hasattr(controller_ms, '__len__'):
+            self.update(controller_ms, host_time)
+
+    def to_host(self, controller_ms):
+        """Converts a controller time in ms to host monotonic seconds, None before the first packet"""
+        if self.offset is None:
+            return None
+        return controller_ms / 1000.0 + self.offset
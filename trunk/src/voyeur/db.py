@@ -1,8 +1,12 @@
 import time
 import os.path
+import threading
 import tables
-from numpy import array, ndarray, int32, float32, int16
+from Queue import Queue
+from configobj import ConfigObj
+from numpy import array, ndarray, int32, float32, int16, zeros, concatenate
 from datetime import datetime
+from voyeur.exceptions import PersistorException
 
 # Column types
 Int = tables.Int32Col()
@@ -28,12 +32,170 @@ ProtocolGroup = tables.group
 
 """Persistent Format And Database Operations"""
 
+# Stream array layouts
+# trial   -- one VLArray per stream and trial, one row per packet (TrialNNNN/<stream>)
+# session -- one EArray per stream for the whole session (Streams/<stream>) and the Streams/Index
+#            table mapping each trial and packet to its range of samples
+TRIAL_LAYOUT = 'trial'
+SESSION_LAYOUT = 'session'
+LAYOUTS = (TRIAL_LAYOUT, SESSION_LAYOUT)
+
+# Column of the Events and Trials tables holding the monotonic host time (s) a stream packet
+# or the trial's events were received at, see voyeur.clock.monotonic
+HOST_TIME = 'host_time'
+
+# Columns of the Trials table holding the monotonic host time (s) a trial was scheduled to start
+# at and the time its start command was sent
+INTENDED_START_TIME = 'intended_start_time'
+START_TIME = 'start_time'
+
+# Column of the Events table holding the number of the controller board a stream packet came
+# from, present when streams of several boards are acquired
+BOARD = 'board'
+
+# Node types with their own compression and chunk shape settings
+TRIALS_NODE = 'trials'      # session Trials table
+EVENTS_NODE = 'events'      # per-trial stream Events table
+VLARRAY_NODE = 'vlarray'    # per-trial stream VLArrays (trial layout)
+EARRAY_NODE = 'earray'      # session stream EArrays (session layout)
+INDEX_NODE = 'index'        # Streams/Index table (session layout)
+NODE_TYPES = (TRIALS_NODE, EVENTS_NODE, VLARRAY_NODE, EARRAY_NODE, INDEX_NODE)
+
+# Defaults per node type. A chunk shape of None lets PyTables compute it from the expected rows.
+DEFAULT_FILTERS = {
+    EARRAY_NODE: tables.Filters(complevel=5, complib='zlib', shuffle=True),
+}
+DEFAULT_CHUNKSHAPES = {
+    EVENTS_NODE: 256,
+    VLARRAY_NODE: 512,
+}
+DEFAULT_EXPECTEDROWS = {
+    TRIALS_NODE: 500,
+    EARRAY_NODE: 10000000,
+    INDEX_NODE: 100000,
+}
+
+
+class StreamIndex(tables.IsDescription):
+    """Row of the Streams/Index table of the session layout"""
+    trial = tables.Int32Col(pos=0)
+    packet = tables.Int32Col(pos=1)
+    channel = tables.StringCol(32, pos=2)
+    start = tables.Int64Col(pos=3)
+    stop = tables.Int64Col(pos=4)
+
+
+class FlushPolicy(object):
+    """
+    Controls how long stream packets are buffered in memory before they are written to the HDF5 file.
+
+    Buffered packets are written and the file is flushed once max_packets packets are buffered or
+    max_seconds have passed since the last flush, whichever comes first. Buffered packets are
+    always written and flushed at the end of a trial and when the database is closed, so a crash
+    loses at most the buffered packets. FlushPolicy(max_packets=1) flushes every packet.
+    """
+
+    def __init__(self, max_packets=100, max_seconds=1.0):
+        self.max_packets = max_packets
+        self.max_seconds = max_seconds
+
+    def due(self, pending_packets, seconds_since_flush):
+        """True when buffered packets should be written and flushed"""
+        return pending_packets >= self.max_packets \
+            or (self.max_seconds is not None and seconds_since_flush >= self.max_seconds)
+
 
 class Persistor(object):
     """Database helper class"""
     
     h5file = None
 
+    def __init__(self, flush_policy=None, layout=TRIAL_LAYOUT, filters=None, chunkshapes=None):
+        """
+        :param flush_policy: FlushPolicy of buffered stream packets
+        :param layout: TRIAL_LAYOUT or SESSION_LAYOUT
+        :param filters: tables.Filters for every node type, or a {node type => tables.Filters} dict
+                        overriding DEFAULT_FILTERS
+        :param chunkshapes: {node type => chunk shape} dict overriding DEFAULT_CHUNKSHAPES
+        """
+        if flush_policy is None:
+            flush_policy = FlushPolicy()
+        if layout not in LAYOUTS:
+            raise ValueError("Unknown stream layout: %s" % layout)
+        self.flush_policy = flush_policy
+        self.layout = layout
+        self.filters = dict(DEFAULT_FILTERS)
+        if isinstance(filters, tables.Filters):
+            self.filters = dict((node_type, filters) for node_type in NODE_TYPES)
+        elif filters:
+            self.filters.update(filters)
+        self.chunkshapes = dict(DEFAULT_CHUNKSHAPES)
+        if chunkshapes:
+            self.chunkshapes.update(chunkshapes)
+        # Stream packets of _stream_group waiting to be written
+        self._stream_group = None
+        self._stream_nodes = {}
+        self._stream_packets = 0
+        self._session_nodes = {}
+        self._pending_rows = []
+        self._pending_arrays = {}
+        self._pending_packets = 0
+        self._last_flush = time.time()
+        # (session_group, {column => value}) of the current trial's Trials row
+        self._pending_trial = None
+
+    @classmethod
+    def from_config(cls, configFile, flush_policy=None, layout=None, filters=None, chunkshapes=None):
+        """
+        Creates a Persistor from the [persistor] section of a Voyeur config file.
+
+        Arguments that are not None take precedence over the config file. Example section::
+
+            [persistor]
+                layout = session
+                flush_packets = 100
+                flush_seconds = 1.0
+                [[filters]]
+                    complib = blosc:lz4   # zlib, lzo, bzip2, blosc, blosc:lz4, blosc:zstd...
+                    complevel = 5
+                    shuffle = True
+                    [[[trials]]]          # per node type settings
+                        complevel = 0
+                [[chunkshape]]
+                    events = 256
+                    vlarray = auto        # computed by PyTables
+        """
+        section = {}
+        if configFile is not None:
+            section = ConfigObj(configFile).get('persistor', {})
+        if flush_policy is None:
+            flush_policy = FlushPolicy(int(section.get('flush_packets', 100)),
+                                       float(section.get('flush_seconds', 1.0)))
+        if layout is None:
+            layout = section.get('layout', TRIAL_LAYOUT)
+        if filters is None and 'filters' in section:
+            filters = filters_from_config(section['filters'])
+        if chunkshapes is None and 'chunkshape' in section:
+            chunkshapes = {}
+            for node_type, chunkshape in section['chunkshape'].items():
+                if chunkshape == 'auto':
+                    chunkshapes[node_type] = None
+                else:
+                    chunkshapes[node_type] = int(chunkshape)
+        return cls(flush_policy=flush_policy, layout=layout, filters=filters, chunkshapes=chunkshapes)
+
+    def node_options(self, node_type):
+        """Keyword arguments (filters, chunkshape, expectedrows) for creating a node of node_type"""
+        chunkshape = self.chunkshapes.get(node_type)
+        if node_type == EARRAY_NODE and isinstance(chunkshape, (int, long)):
+            # EArrays take a shape; samples per chunk along the extendable dimension
+            chunkshape = (chunkshape,)
+        options = {'filters': self.filters.get(node_type),
+                   'chunkshape': chunkshape}
+        if node_type in DEFAULT_EXPECTEDROWS:
+            options['expectedrows'] = DEFAULT_EXPECTEDROWS[node_type]
+        return options
+
     def create_database(self, filename, metadata):
         """
         Create database file and add initial metadata attributes.
@@ -51,6 +213,8 @@ class Persistor(object):
         session_group = self.h5file.root #create_group("/", group_name, user_metadata)
         for k, v in metadata.iteritems():
             session_group._f_setattr(k, v)
+        session_group._f_setattr('streamLayout', self.layout)
+        self._session_nodes = {}
         self.h5file.flush()
         
         return session_group
@@ -66,12 +230,16 @@ class Persistor(object):
             trial_columns_definition = dict(protocol_parameters_definition.items() 
                                         + strip_tuple_from_dict(controller_parameters_definition).items()
                                         + strip_tuple_from_dict(event_definition).items())
+            trial_columns_definition[HOST_TIME] = Double
+            # NaN until set_trial_start, e.g. for a trial stopped before its start command was sent
+            trial_columns_definition[INTENDED_START_TIME] = tables.Float64Col(dflt=float('nan'))
+            trial_columns_definition[START_TIME] = tables.Float64Col(dflt=float('nan'))
             
             self.h5file.create_table(session_group,
                                     'Trials',
                                     trial_columns_definition,
                                     description,
-                                    expectedrows = 500)
+                                    **self.node_options(TRIALS_NODE))
  
             self.h5file.flush()
             
@@ -88,10 +256,14 @@ class Persistor(object):
                                                 "Trial" + str(trial_number).zfill(4),
                                                 description)
         
+        trial_group._v_attrs.trialNumber = trial_number
         stream_def = strip_tuple_from_dict(stream_definition)
         if stream_def is not None:
             for name, kind in stream_def.items():
-                if type(kind).__name__ == 'ndarray':
+                if type(kind).__name__ == 'ndarray' and self.layout == SESSION_LAYOUT:
+                    self._session_stream_array(name, kind)
+                    del stream_def[name]
+                elif type(kind).__name__ == 'ndarray':
                     if kind.dtype == int32:
                         self.create_VLIntArray(name, IntArray, trial_group)
                     elif kind.dtype == float32:
@@ -100,61 +272,228 @@ class Persistor(object):
                         self.create_VLInt16Array(name, Int16Array, trial_group)
                     del stream_def[name]
         
-        if (stream_def is not None) and len(stream_def) != 0:
-            self.h5file.create_table(trial_group,
-                                    'Events',
-                                    stream_def,
-                                    "Stream Data",
-                                    chunkshape = 256)
-                                    
+        # every stream packet gets a row with its receive time, also if all streams are arrays
+        stream_def = dict(stream_def or {})
+        stream_def[HOST_TIME] = Double
+        self.h5file.create_table(trial_group,
+                                 'Events',
+                                 stream_def,
+                                 "Stream Data",
+                                 **self.node_options(EVENTS_NODE))
+
         #print protocol_parameters
         #print strip_tuple_from_dict(controller_parameters)
         trial_parameters = dict(protocol_parameters.items() 
                                 + strip_tuple_from_dict(controller_parameters).items())
         #print trial_parameters
-        parameters = session_group.Trials.row
+        # The Trials row is kept in memory until insert_event completes it with the event values
+        self._commit_pending_trial()
         trial_group._v_attrs.trialIndex = len(session_group.Trials)
-        #print parameters
-        for key, value in trial_parameters.items():
-            #print key, value
-            parameters[key] = value
-        parameters.append()
-        session_group.Trials.flush()
+        self._pending_trial = (session_group, trial_parameters)
         self.h5file.flush()
         return trial_group
         
-    def insert_event(self, event, trial_group):
-        """Inserts event values"""
-        rowindex = trial_group.Trials.nrows-1
-        row = trial_group.Trials[rowindex]
-
-        for key, value in event.iteritems():
-            row[key] = value
-
-        row = array(row,ndmin=1)
-        trial_group.Trials.modify_rows(start=rowindex, stop=rowindex+1, rows=row)
-        trial_group.Trials.flush()
-        """for index in range(trial_group.Trials.nrows):
-            print trial_group.Trials[index]"""
-            
+    def set_trial_start(self, intended_start_time, start_time):
+        """Stores the start times of the trial added last in its pending Trials row"""
+        if self._pending_trial is not None:
+            row = self._pending_trial[1]
+            row[INTENDED_START_TIME] = intended_start_time
+            row[START_TIME] = start_time
+
+    def discard_trial(self, trial_group):
+        """Removes a trial added with add_trial that was never run, with its pending Trials row"""
+        self._pending_trial = None
+        trial_group._f_remove(recursive=True)
+        self.h5file.flush()
+
+    def insert_event(self, event, session_group):
+        """Completes the Trials row of the current trial with the event values and appends it"""
+        row = {}
+        if self._pending_trial is not None:
+            row = self._pending_trial[1]
+            self._pending_trial = None
+        row.update(event)
+        self.insert_trials([row], session_group)
+
+    def insert_trials(self, rows, session_group):
+        """
+        Appends Trials rows in a single write.
+
+        :param rows: List of {column => value} dicts. Missing columns get the column default.
+        :param session_group: Group holding the Trials table.
+        """
+        trials = session_group.Trials
+        trials.append(self._records(trials, rows))
+        trials.flush()
+        self.h5file.flush()
 
-        self.h5file.flush()        
+    def _commit_pending_trial(self):
+        """Appends the row of a trial that ended without events"""
+        if self._pending_trial is not None:
+            session_group, row = self._pending_trial
+            self._pending_trial = None
+            self.insert_trials([row], session_group)
+
+    def _records(self, table, rows):
+        """Builds a record array for table from a list of {column => value} dicts"""
+        records = zeros(len(rows), dtype=table.dtype)
+        for name, default in table.coldflts.items():
+            records[name] = default
+        for index, values in enumerate(rows):
+            for key, value in values.iteritems():
+                records[key][index] = value
+        return records
 
     def insert_stream(self, stream, trial_group):
-        """Inserts stream data values"""
-        row = trial_group.Events.row
+        """
+        Inserts stream data values.
+
+        Packets are buffered in memory and written according to flush_policy.
+        """
+        if trial_group is not self._stream_group:
+            self.flush_streams()
+            self._stream_group = trial_group
+            self._stream_nodes = {}
+            self._stream_packets = 0
+
+        values = {}
         for key, value in stream.iteritems():
             if type(value) == ndarray:
-                array = self.h5file.get_node(trial_group, key)
-                array.append(value)
+                self._pending_arrays.setdefault(key, []).append((self._stream_packets, value))
             elif value is None:
                 continue
             else:
-                #row = trial_group.Events.row
-                row[key] = value
-        row.append()
-        trial_group.Events.flush()
-        self.h5file.flush()
+                values[key] = value
+        self._pending_rows.append(values)
+        self._pending_packets += 1
+        self._stream_packets += 1
+
+        if self.flush_policy.due(self._pending_packets, time.time() - self._last_flush):
+            self.flush_streams()
+
+    def flush_streams(self):
+        """
+        Writes the buffered stream packets and flushes the file.
+
+        Each node is written on its own, so a node that cannot be written does not keep the
+        others from being written. The buffered packets are discarded either way; the first
+        error is raised as a PersistorException once all nodes were written.
+        """
+        trial_group = self._stream_group
+        try:
+            if self._pending_packets and trial_group is not None:
+                writes = [('Events', self._write_events)]
+                if self.layout == SESSION_LAYOUT:
+                    writes.append(('Streams', self._write_session_arrays))
+                else:
+                    writes.extend((key, lambda trial_group, key=key: self._write_vlarray(trial_group, key))
+                                  for key in self._pending_arrays)
+                error = None
+                for node, write in writes:
+                    try:
+                        write(trial_group)
+                    except PersistorException as e:
+                        error = error or e
+                    except Exception as e:
+                        # e.g. a stream key the Events table has no column for
+                        error = error or PersistorException(node, '%s: %s' % (type(e).__name__, e))
+                self.h5file.flush()
+                if error is not None:
+                    raise error
+        finally:
+            self._pending_rows = []
+            self._pending_arrays = {}
+            self._pending_packets = 0
+            self._last_flush = time.time()
+
+    def _write_events(self, trial_group):
+        """Appends the buffered Events rows"""
+        events = self._stream_node(trial_group, 'Events')
+        if events is not None:
+            events.append(self._records(events, self._pending_rows))
+            events.flush()
+
+    def _write_vlarray(self, trial_group, key):
+        """Appends the buffered arrays of stream key to its VLArray"""
+        vlarray = self._stream_node(trial_group, key)
+        if vlarray is None:
+            raise PersistorException(key, "Array stream has no VLArray in " + trial_group._v_pathname)
+        for packet, value in self._pending_arrays[key]:
+            vlarray.append(value)
+        vlarray.flush()
+
+    def end_trial(self, trial_group, statistics=None):
+        """
+        Writes and flushes the buffered stream packets of trial_group.
+
+        statistics is an optional dictionary of acquisition counters (e.g. lost and corrupt
+        stream packets) stored as attributes of trial_group.
+        """
+        if trial_group is self._stream_group:
+            self.flush_streams()
+        if statistics:
+            for key, value in statistics.items():
+                setattr(trial_group._v_attrs, key, value)
+
+    def _write_session_arrays(self, trial_group):
+        """Appends the buffered arrays to the session EArrays and indexes their sample ranges"""
+        trial_number = trial_group._v_attrs.trialNumber
+        missing = [key for key in self._pending_arrays if key not in self._session_nodes]
+        if missing:
+            raise PersistorException(', '.join(missing), "Array streams have no session EArray")
+        index_rows = []
+        for key, arrays in self._pending_arrays.iteritems():
+            earray = self._session_nodes[key]
+            start = earray.nrows
+            earray.append(concatenate([value for packet, value in arrays]))
+            earray.flush()
+            for packet, value in arrays:
+                stop = start + len(value)
+                index_rows.append({'trial': trial_number, 'packet': packet,
+                                   'channel': key, 'start': start, 'stop': stop})
+                start = stop
+        if index_rows:
+            index = self._session_nodes['Index']
+            index.append(self._records(index, index_rows))
+            index.flush()
+
+    def _session_stream_array(self, name, kind):
+        """Returns the session EArray of stream name, creating it (and the Streams group) if needed"""
+        if name not in self._session_nodes:
+            root = self.h5file.root
+            if 'Streams' not in root:
+                streams = self.h5file.create_group(root, 'Streams', "Stream Data")
+            else:
+                streams = root.Streams
+            if 'Index' not in streams:
+                self.h5file.create_table(streams,
+                                        'Index',
+                                        StreamIndex,
+                                        "Sample ranges of each trial and packet",
+                                        **self.node_options(INDEX_NODE))
+            self._session_nodes['Index'] = streams.Index
+            if name not in streams:
+                self.h5file.create_earray(streams,
+                                        name,
+                                        tables.Atom.from_dtype(kind.dtype),
+                                        (0,),
+                                        "Session stream samples",
+                                        **self.node_options(EARRAY_NODE))
+            self._session_nodes[name] = streams._f_get_child(name)
+        return self._session_nodes[name]
+
+    def read_trial_stream(self, name, trial_number, packets=False):
+        """Reads the samples of stream name for a trial of a session layout file. See :func:`read_trial_stream`."""
+        return read_trial_stream(self.h5file, name, trial_number, packets)
+
+    def _stream_node(self, trial_group, name):
+        """Returns the node name of trial_group, looked up once per trial group. None if there is no such node."""
+        if name not in self._stream_nodes:
+            if name in trial_group:
+                self._stream_nodes[name] = trial_group._f_get_child(name)
+            else:
+                self._stream_nodes[name] = None
+        return self._stream_nodes[name]
 
     def store_array(self, name, description, array, group):
         """Stores a homogenous array in a group"""
@@ -166,7 +505,7 @@ class Persistor(object):
                                     name,
                                     tables.Int32Atom(),
                                     "ragged array of ints",
-                                    chunkshape = 512)
+                                    **self.node_options(VLARRAY_NODE))
 
     def create_VLFloatArray(self, name, array, group):
         """Stores a homogenous variable length float array in a group"""
@@ -174,7 +513,7 @@ class Persistor(object):
                                     name,
                                     tables.Float32Atom(),
                                     "ragged array of floats",
-                                    chunkshape = 512)
+                                    **self.node_options(VLARRAY_NODE))
 
     def create_VLInt16Array(self, name, array, group):
         """Stores a homogenous variable length float array in a group"""
@@ -182,7 +521,7 @@ class Persistor(object):
                                     name,
                                     tables.Int16Atom(),
                                     "ragged array of floats",
-                                    chunkshape = 512)
+                                    **self.node_options(VLARRAY_NODE))
                                                                     
     def open_database(self, name, mode):
         """Open HDF5 database"""
@@ -192,7 +531,14 @@ class Persistor(object):
             self.h5file = tables.open_file(name + ".h5", mode = mode)
                     
     def close_database(self):
-        self.h5file.close()
+        try:
+            self.flush_streams()
+            self._commit_pending_trial()
+        finally:
+            self._stream_group = None
+            self._stream_nodes = {}
+            self._session_nodes = {}
+            self.h5file.close()
 
     def timestamp(self):
         """Creates a UTC timestamp"""
@@ -223,6 +569,222 @@ class Persistor(object):
         return self.h5file.filename
 
 
+class PersistorThread(threading.Thread):
+    """
+    Performs the database operations of a Persistor on a dedicated writer thread.
+
+    Stream and event inserts are queued on a bounded queue and return immediately; when the
+    queue is full the caller blocks until the writer catches up. All other operations are
+    queued as well and wait for their result, so every HDF5 call happens on the writer thread
+    in submission order. close_database() drains the queue first, so every queued packet is on
+    disk before the file is closed.
+
+    Queued operations do not report errors to their caller; the first exception raised by one
+    is raised by the next enqueue() or close_database() instead, as a PersistorException.
+    """
+
+    def __init__(self, persistor=None, max_queue_size=1000):
+        threading.Thread.__init__(self, name='PersistorThread')
+        self.daemon = True
+        if persistor is None:
+            persistor = Persistor()
+        self.persistor = persistor
+        self.queue = Queue(maxsize=max_queue_size)
+        self._database_open = False
+        # First exception raised by a queued operation nobody waited for, raised to the next caller
+        self._error = None
+
+    def enqueue(self, fn, *args, **kwargs):
+        """
+        Queues fn to run on the writer thread and returns immediately.
+
+        Raises the exception of an earlier queued operation if one failed (fn is queued anyway).
+        """
+        self._ensure_running()
+        self.queue.put((fn, args, kwargs, None), block=True)
+        self._raise_error()
+
+    def call(self, fn, *args, **kwargs):
+        """Queues fn to run on the writer thread and returns its result once it has run"""
+        if threading.current_thread() is self:
+            return fn(*args, **kwargs)
+        self._ensure_running()
+        result = _CallResult()
+        self.queue.put((fn, args, kwargs, result), block=True)
+        return result.wait()
+
+    def drain(self):
+        """Blocks until every queued operation has been performed"""
+        if self.is_alive():
+            self.queue.join()
+
+    def close(self):
+        """Drains the queue and stops the writer thread"""
+        if self.is_alive():
+            self.queue.put(None, block=True)
+            self.join()
+
+    def run(self):
+        while True:
+            item = self.queue.get(block=True)
+            if item is None:
+                self.queue.task_done()
+                return
+            fn, args, kwargs, result = item
+            try:
+                value = fn(*args, **kwargs)
+                if result is not None:
+                    result.set(value)
+            except Exception as e:
+                if result is not None:
+                    result.set_exception(e)
+                elif self._error is None:
+                    if not isinstance(e, PersistorException):
+                        e = PersistorException(getattr(fn, '__name__', str(fn)), '%s: %s' % (type(e).__name__, e))
+                    self._error = e
+            finally:
+                self.queue.task_done()
+
+    def _raise_error(self):
+        """Raises the exception of a failed queued operation once"""
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def _ensure_running(self):
+        if not self.is_alive():
+            self.start()
+
+    # Persistor interface
+
+    def create_database(self, filename, metadata):
+        session_group = self.call(self.persistor.create_database, filename, metadata)
+        self._database_open = True
+        return session_group
+
+    def create_trials(self, *args, **kwargs):
+        return self.call(self.persistor.create_trials, *args, **kwargs)
+
+    def add_trial(self, *args, **kwargs):
+        return self.call(self.persistor.add_trial, *args, **kwargs)
+
+    def discard_trial(self, trial_group):
+        if self._database_open:
+            self.call(self.persistor.discard_trial, trial_group)
+
+    def set_trial_start(self, intended_start_time, start_time):
+        if self._database_open:
+            self.enqueue(self.persistor.set_trial_start, intended_start_time, start_time)
+
+    def insert_event(self, event, session_group):
+        if self._database_open:
+            self.enqueue(self.persistor.insert_event, event, session_group)
+
+    def insert_trials(self, rows, session_group):
+        if self._database_open:
+            self.enqueue(self.persistor.insert_trials, rows, session_group)
+
+    def insert_stream(self, stream, trial_group):
+        if self._database_open:
+            self.enqueue(self.persistor.insert_stream, stream, trial_group)
+
+    def end_trial(self, trial_group, statistics=None):
+        if self._database_open:
+            self.enqueue(self.persistor.end_trial, trial_group, statistics)
+
+    def open_database(self, name, mode):
+        self.call(self.persistor.open_database, name, mode)
+        self._database_open = True
+
+    def close_database(self):
+        self._database_open = False
+        self.drain()
+        # the file is closed also if a queued operation failed
+        error, self._error = self._error, None
+        self.call(self.persistor.close_database)
+        if error is not None:
+            raise error
+
+    def database_file(self):
+        return self.call(self.persistor.database_file)
+
+
+class _CallResult(object):
+    """Result of a PersistorThread.call, handed from the writer thread to the caller"""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._value = None
+        self._exception = None
+
+    def set(self, value):
+        self._value = value
+        self._done.set()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._done.set()
+
+    def wait(self):
+        self._done.wait()
+        if self._exception is not None:
+            raise self._exception
+        return self._value
+
+
+def filters_from_config(section):
+    """
+    Builds {node type => tables.Filters} from a [[filters]] config section.
+
+    Top level complib, complevel and shuffle values apply to every node type, subsections
+    named after a node type override them for that type.
+    """
+    def parse(values, base):
+        options = dict(base)
+        if 'complib' in values:
+            options['complib'] = values['complib']
+        if 'complevel' in values:
+            options['complevel'] = int(values['complevel'])
+        if 'shuffle' in values:
+            options['shuffle'] = str(values['shuffle']).lower() in ('true', 'yes', 'on', '1')
+        return options
+
+    defaults = parse(section, {})
+    filters = {}
+    for node_type in NODE_TYPES:
+        if defaults or node_type in section:
+            filters[node_type] = tables.Filters(**parse(section.get(node_type, {}), defaults))
+    return filters
+
+
+def read_trial_stream(h5file, name, trial_number, packets=False):
+    """
+    Reads the samples of stream name for one trial from a session layout file.
+
+    A trial's samples are contiguous in the session EArray, so they are read with a single slice.
+    With packets=True, also returns a list of per-packet views into the samples (no copies).
+
+    :param h5file: Open tables.File written with the session layout
+    :param name: Stream name, as in the protocol's stream_definition()
+    :param trial_number: Trial number, as passed to Persistor.add_trial
+    :return: samples array, or (samples, packet views) if packets is True
+    """
+    streams = h5file.root.Streams
+    rows = streams.Index.read_where('(trial == number) & (channel == name)',
+                                    condvars={'number': trial_number, 'name': name})
+    earray = streams._f_get_child(name)
+    if len(rows) == 0:
+        samples = earray[0:0]
+    else:
+        start = rows['start'].min()
+        samples = earray[start:rows['stop'].max()]
+    if not packets:
+        return samples
+    rows.sort(order='packet')
+    views = [samples[row['start'] - start:row['stop'] - start] for row in rows]
+    return samples, views
+
+
 def strip_tuple_from_dict(dict):
     """ Calls the correct tuple stripper"""
     if dict:
@@ -0,0 +1,123 @@
+import threading
+from numpy import ndarray, empty, concatenate, zeros
+
+"""Decimated display buffers"""
+
+
+class DecimatingRing(object):
+    """
+    Fixed-size ring of min/max bins over a sample stream.
+
+    Every decimation consecutive samples become one bin holding their minimum and maximum,
+    so plotting the bins as an envelope shows the same peaks as the full-rate trace. Samples
+    that do not fill a bin yet are kept for the next append.
+    """
+
+    def __init__(self, width, decimation, dtype=float):
+        self.width = width
+        self.decimation = max(1, decimation)
+        self.mins = zeros(width, dtype=dtype)
+        self.maxs = zeros(width, dtype=dtype)
+        self.count = 0
+        self._next = 0
+        self._partial = None
+
+    def append(self, samples):
+        if self._partial is not None and len(self._partial):
+            samples = concatenate((self._partial, samples))
+        bins = len(samples) // self.decimation
+        used = bins * self.decimation
+        self._partial = samples[used:].copy()
+        if not bins:
+            return
+        binned = samples[:used].reshape(bins, self.decimation)
+        mins = binned.min(axis=1)
+        maxs = binned.max(axis=1)
+        if bins > self.width:
+            mins = mins[-self.width:]
+            maxs = maxs[-self.width:]
+            bins = self.width
+        first = min(bins, self.width - self._next)
+        self.mins[self._next:self._next + first] = mins[:first]
+        self.maxs[self._next:self._next + first] = maxs[:first]
+        self.mins[:bins - first] = mins[first:]
+        self.maxs[:bins - first] = maxs[first:]
+        self._next = (self._next + bins) % self.width
+        self.count = min(self.width, self.count + bins)
+
+    def view(self):
+        """Returns copies of the (mins, maxs) of the bins, oldest first"""
+        if self.count < self.width:
+            return self.mins[:self.count].copy(), self.maxs[:self.count].copy()
+        order = concatenate((self.mins[self._next:], self.mins[:self._next]))
+        return order, concatenate((self.maxs[self._next:], self.maxs[:self._next]))
+
+    def envelope(self):
+        """Returns the bins as one array alternating min and max, for plotting as a line"""
+        mins, maxs = self.view()
+        envelope = empty(2 * len(mins), dtype=mins.dtype)
+        envelope[0::2] = mins
+        envelope[1::2] = maxs
+        return envelope
+
+
+class DisplayBuffer(object):
+    """
+    Display stage between acquisition and protocol plotting.
+
+    Array streams are min/max decimated into a DecimatingRing per stream, sized to the plot
+    width; the latest value of every other stream is kept in latest. Streams are added on the
+    acquisition thread, and the protocol pulls the views on the UI thread at a capped rate
+    (see IProtocol.update_display), so plotting cost does not grow with the sample rate.
+
+    Arguments:
+        width      -- bins per ring, e.g. the plot width in pixels
+        decimation -- samples per bin, an int for all streams or a {stream => int} dictionary
+                      (streams not in it are not decimated)
+    """
+
+    def __init__(self, width=1000, decimation=10):
+        self.width = width
+        self.decimation = decimation
+        self.rings = {}
+        self.latest = {}
+        # incremented by every add(), to skip redrawing unchanged views
+        self.updates = 0
+        self._lock = threading.Lock()
+
+    def add(self, stream):
+        with self._lock:
+            for key, value in stream.iteritems():
+                if type(value) == ndarray:
+                    ring = self.rings.get(key)
+                    if ring is None:
+                        ring = self.rings[key] = DecimatingRing(self.width, self._decimation(key), value.dtype)
+                    ring.append(value)
+                elif value is not None:
+                    self.latest[key] = value
+            self.updates += 1
+
+    def view(self, key):
+        """(mins, maxs) of stream key, oldest first"""
+        with self._lock:
+            return self.rings[key].view()
+
+    def envelope(self, key):
+        """Min/max envelope of stream key, see DecimatingRing.envelope"""
+        with self._lock:
+            return self.rings[key].envelope()
+
+    def keys(self):
+        with self._lock:
+            return self.rings.keys()
+
+    def clear(self):
+        with self._lock:
+            self.rings = {}
+            self.latest = {}
+            self.updates += 1
+
+    def _decimation(self, key):
+        if isinstance(self.decimation, dict):
+            return self.decimation.get(key, 1)
+        return self.decimation
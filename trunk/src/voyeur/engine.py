@@ -0,0 +1,212 @@
+import os
+import select
+import threading
+from collections import deque
+from voyeur.clock import monotonic, sleep_until
+from voyeur.eventloop import WorkerThread
+import voyeur.exceptions as ex
+
+"""Single-threaded serial acquisition engine"""
+
+
+class EngineChannel(object):
+    """
+    A serial port served by the SerialEngine.
+
+    Arguments:
+        port           -- the voyeur.arduino.SerialPort
+        plan           -- callable returning the StreamPlan to acquire with, None while not acquiring
+        push           -- callable returning True if the controller pushes streams (no requests)
+        deliver        -- callable taking each decoded stream packet
+        end_of_trial   -- callable taking the last packet of a trial, None to deliver it like the others
+    """
+
+    def __init__(self, port, plan, push, deliver, end_of_trial=None):
+        self.port = port
+        self.plan = plan
+        self.push = push
+        self.deliver = deliver
+        self.end_of_trial = end_of_trial
+        # monotonic time the outstanding stream request was sent, None if there is none
+        self.requested = None
+        # monotonic time an incomplete packet was first seen, None if there is none
+        self.waiting_since = None
+
+
+class SerialEngine(WorkerThread):
+    """
+    One thread serving the serial ports of all boards, in place of an AcquisitionThread and a
+    SerialCallThread per port.
+
+    Every loop iteration runs the queued calls (start and end of trial, event requests, user
+    commands), sends a stream request to each request mode port without one outstanding, and
+    decodes the packets that have completely arrived on any port. Ports are never read before
+    their data is there, so requests to all ports are outstanding at the same time. The engine
+    sleeps in select() on the ports and a wake-up pipe (POSIX), or polls every poll_interval
+    seconds if a port cannot be selected (e.g. on Windows).
+
+    Calls queued with enqueue_at() wait for their deadline in the queue, while the engine keeps
+    serving the ports and shortens its sleep to wake up for them.
+
+    enqueue(), enqueue_at(), start() and isRunning() work like SerialCallThread's, so the engine
+    can stand in for the Monitor's serial queues.
+    """
+
+    # Seconds before the deadline of a timed call the engine stops serving the ports to run it
+    timed_call_lead = 0.002
+
+    def __init__(self, monitor=None, poll_interval=0.001, QObject_parent=None):
+        WorkerThread.__init__(self, QObject_parent)
+        self.monitor = monitor
+        self.poll_interval = poll_interval
+        self.channels = []
+        self._calls = deque()
+        self._condition = threading.Condition()
+        self._wake_read = self._wake_write = None
+        if os.name == 'posix':
+            self._wake_read, self._wake_write = os.pipe()
+
+    def add_channel(self, channel):
+        self.channels.append(channel)
+
+    def restarted(self):
+        """
+        Starts the engine unless it is running, and returns the running engine. A finished engine
+        is replaced by a new one with its channels and queued calls, see SerialCallThread.restarted.
+        """
+        if self.isRunning():
+            return self
+        engine = self
+        if self.isFinished():
+            engine = SerialEngine(monitor=self.monitor, poll_interval=self.poll_interval)
+            engine.channels = self.channels
+            with self._condition:
+                engine._calls.extend(self._calls)
+                self._calls.clear()
+            if self._wake_read is not None:
+                os.close(self._wake_read)
+                os.close(self._wake_write)
+                self._wake_read = self._wake_write = None
+        engine.start()
+        return engine
+
+    def enqueue(self, fn, *args, **kwargs):
+        """Queues fn to run on the engine thread and returns immediately"""
+        self.enqueue_at(None, fn, *args, **kwargs)
+
+    def enqueue_at(self, deadline, fn, *args, **kwargs):
+        """
+        Queues fn to run on the engine thread at monotonic time deadline (as soon as possible if
+        None) and returns immediately. Calls run in queue order, so later calls wait for it.
+        """
+        with self._condition:
+            self._calls.append((deadline, fn, args, kwargs))
+            self._condition.notify()
+        if self._wake_write is not None:
+            os.write(self._wake_write, 'x')
+
+    def run(self):
+        try:
+            from Foundation import NSAutoreleasePool
+            pool = NSAutoreleasePool.alloc().init()
+        except ImportError:
+            pass # Windows
+
+        while self.monitor.running or self._calls:
+            until_call = self._until_next_call()
+            if until_call is not None and until_call <= self.timed_call_lead:
+                # replies to the calls must not interleave with outstanding stream replies
+                self._complete_requests()
+                with self._condition:
+                    deadline, fn, args, kwargs = self._calls.popleft()
+                if deadline is not None and self.monitor.running:
+                    sleep_until(deadline)
+                fn(*args, **kwargs)
+                continue
+            if not self.monitor.running:
+                break
+            progress = False
+            for channel in self.channels:
+                progress = self._serve(channel) or progress
+            if not progress:
+                self._wait(until_call)
+
+    def _until_next_call(self):
+        """Seconds until the next queued call is due, 0 if it is due now, None if none is queued"""
+        with self._condition:
+            if not self._calls:
+                return None
+            deadline = self._calls[0][0]
+        if deadline is None or not self.monitor.running:
+            # once acquisition stops, the remaining calls run right away
+            return 0
+        return deadline - monotonic()
+
+    def _serve(self, channel):
+        """Requests and reads the streams of channel. Returns True if a packet was read."""
+        plan = channel.plan()
+        if plan is None and channel.requested is None:
+            return False
+        port = channel.port
+        if channel.requested is None and not channel.push():
+            port.send_stream_request()
+            channel.requested = monotonic()
+        if port.stream_arrived():
+            channel.waiting_since = None
+            self._read(channel, plan)
+            return True
+        if channel.requested is not None or port.framer.available():
+            # a packet is on its way; if it stays incomplete for longer than the port timeout,
+            # let the blocking read time out and discard it
+            now = monotonic()
+            if channel.waiting_since is None:
+                channel.waiting_since = now
+            elif now - channel.waiting_since > (getattr(port.serial, 'timeout', None) or 1):
+                channel.waiting_since = None
+                self._read(channel, plan)
+                return True
+        return False
+
+    def _read(self, channel, plan):
+        channel.requested = None
+        try:
+            stream = channel.port.read_stream(plan)
+            if stream:
+                channel.deliver(stream)
+        except ex.EndOfTrialException as e:
+            if channel.end_of_trial is not None:
+                channel.end_of_trial(e.last_read)
+            elif e.last_read:
+                channel.deliver(e.last_read)
+        except ex.ProtocolException:
+            pass
+        except:
+            print "Exception in acquisition engine"
+            self.monitor.stop_acquisition()
+
+    def _complete_requests(self):
+        """Reads the replies of all outstanding stream requests"""
+        for channel in self.channels:
+            if channel.requested is not None:
+                self._read(channel, channel.plan())
+
+    def _wait(self, until_call=None):
+        """Waits for port data or a queued call, at most until until_call seconds before a timed call"""
+        descriptors = [channel.port.fileno() for channel in self.channels]
+        if self._wake_read is not None and None not in descriptors:
+            timeout = 0.05
+            if until_call is not None:
+                timeout = min(timeout, until_call - self.timed_call_lead)
+            # woken up by data, a call, or to check for packets that stay incomplete
+            readable, writable, errors = select.select(descriptors + [self._wake_read], [], [], timeout)
+            if self._wake_read in readable:
+                os.read(self._wake_read, 4096)
+        else:
+            acquiring = [channel for channel in self.channels if channel.plan() is not None]
+            timeout = self.poll_interval if acquiring else 0.5
+            with self._condition:
+                if until_call is not None:
+                    # only a timed call is queued, see run()
+                    self._condition.wait(min(timeout, until_call - self.timed_call_lead))
+                elif not self._calls:
+                    self._condition.wait(timeout)
@@ -0,0 +1,236 @@
+import sys
+import heapq
+import inspect
+import itertools
+import threading
+from collections import deque
+from traits.etsconfig.etsconfig import ETSConfig
+from voyeur.clock import monotonic
+
+"""
+Event loop backend of the Monitor: the Qt event loop, or a stdlib threading event loop when
+the ETS_TOOLKIT environment variable is 'null' (headless).
+
+Both provide WorkerThread (QThread API subset), Timer (QTimer API subset), on_ui_event()
+to run trait event handlers on the event loop thread, and init()/run()/quit() for the loop itself.
+"""
+
+HEADLESS = ETSConfig.toolkit == 'null'
+
+
+class Signal(object):
+    """Minimal stand-in for a Qt signal"""
+
+    def __init__(self):
+        self._slots = []
+
+    def connect(self, slot):
+        self._slots.append(slot)
+
+    def disconnect(self, slot=None):
+        if slot is None:
+            self._slots = []
+        else:
+            self._slots.remove(slot)
+
+    def emit(self, *args):
+        for slot in list(self._slots):
+            slot(*args)
+
+
+class EventLoop(object):
+    """
+    Single-threaded loop running posted calls and due timers in order, for headless mode.
+
+    The loop thread is the thread that called run(), or the thread that created the loop
+    until run() is called.
+    """
+
+    def __init__(self):
+        self.thread = threading.current_thread()
+        self._condition = threading.Condition()
+        self._calls = deque()
+        self._timers = []
+        self._order = itertools.count()
+        self._running = False
+
+    def post(self, fn, *args):
+        """Queues fn(*args) to run on the loop thread"""
+        with self._condition:
+            self._calls.append((fn, args))
+            self._condition.notify()
+
+    def call_later(self, seconds, fn):
+        """Runs fn on the loop thread after seconds. Returns a handle for cancel()."""
+        entry = [monotonic() + seconds, next(self._order), fn]
+        with self._condition:
+            heapq.heappush(self._timers, entry)
+            self._condition.notify()
+        return entry
+
+    def cancel(self, entry):
+        """Cancels a call_later() call that has not run yet"""
+        with self._condition:
+            entry[2] = None
+
+    def in_loop_thread(self):
+        return threading.current_thread() is self.thread
+
+    def run(self):
+        """Runs posted calls and timers until quit() is called"""
+        self.thread = threading.current_thread()
+        self._running = True
+        while True:
+            with self._condition:
+                while self._running and not self._calls and not self._due():
+                    timeout = None
+                    if self._timers:
+                        timeout = max(0, self._timers[0][0] - monotonic())
+                    self._condition.wait(timeout)
+                if not self._running:
+                    return
+                if self._calls:
+                    fn, args = self._calls.popleft()
+                else:
+                    fn = heapq.heappop(self._timers)[2]
+                    args = ()
+            if fn is not None:
+                fn(*args)
+
+    def quit(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+
+    def _due(self):
+        while self._timers and self._timers[0][2] is None:
+            heapq.heappop(self._timers)
+        return bool(self._timers) and self._timers[0][0] <= monotonic()
+
+
+if HEADLESS:
+    event_loop = EventLoop()
+
+    class WorkerThread(threading.Thread):
+        """threading.Thread with the subset of the QThread API used by Voyeur"""
+
+        def __init__(self, QObject_parent=None):
+            threading.Thread.__init__(self, name=self.__class__.__name__)
+            self.daemon = True
+
+        def isRunning(self):
+            return self.is_alive()
+
+        def isFinished(self):
+            return self.ident is not None and not self.is_alive()
+
+        def wait(self, msecs=None):
+            self.join(None if msecs is None else msecs / 1000.0)
+            return not self.is_alive()
+
+    class Timer(object):
+        """Timer running on the headless event loop, with the subset of the QTimer API used by Voyeur"""
+
+        def __init__(self):
+            self.timeout = Signal()
+            self._single_shot = False
+            self._interval = 0
+            self._entry = None
+
+        def setSingleShot(self, single_shot):
+            self._single_shot = single_shot
+
+        def start(self, msecs=None):
+            if msecs is not None:
+                self._interval = msecs
+            self.stop()
+            self._entry = event_loop.call_later(self._interval / 1000.0, self._fire)
+
+        def stop(self):
+            if self._entry is not None:
+                event_loop.cancel(self._entry)
+                self._entry = None
+
+        def isActive(self):
+            return self._entry is not None
+
+        def deleteLater(self):
+            self.stop()
+
+        def _fire(self):
+            self._entry = None
+            if not self._single_shot:
+                self.start()
+            self.timeout.emit()
+
+    def init():
+        """Prepares the event loop before Timers are created, nothing to do headless"""
+        pass
+
+    def run():
+        """Runs the event loop until quit() is called"""
+        event_loop.run()
+
+    def quit():
+        event_loop.quit()
+
+    def post(fn, *args):
+        """Runs fn(*args) on the event loop thread"""
+        event_loop.post(fn, *args)
+
+else:
+    from PyQt4.QtCore import QThread as WorkerThread, QTimer as Timer
+
+    def _application():
+        from PyQt4.Qt import QApplication
+        return QApplication.instance() or QApplication(sys.argv[:1])
+
+    def init():
+        """Creates the QApplication, which Timers need to fire, unless it exists"""
+        _application()
+
+    def run():
+        """Runs the event loop until quit() is called"""
+        _application().exec_()
+
+    def quit():
+        _application().quit()
+
+    def post(fn, *args):
+        """Runs fn(*args) on the event loop thread"""
+        from pyface.api import GUI
+        GUI.invoke_later(fn, *args)
+
+
+def on_ui_event(obj, handler, name, fast=True):
+    """
+    Registers handler for the trait event name of obj, called on the event loop thread.
+
+    With fast, handler runs immediately when the event fires on the event loop thread
+    (traits' 'fast_ui' dispatch), otherwise it is always queued ('ui' dispatch).
+    """
+    if not HEADLESS:
+        obj.on_trait_event(handler, name, dispatch='fast_ui' if fast else 'ui')
+        return
+
+    if _argument_count(handler):
+        def dispatch(new):
+            if fast and event_loop.in_loop_thread():
+                handler(new)
+            else:
+                event_loop.post(handler, new)
+    else:
+        def dispatch():
+            if fast and event_loop.in_loop_thread():
+                handler()
+            else:
+                event_loop.post(handler)
+    obj.on_trait_event(dispatch, name, dispatch='same')
+
+
+def _argument_count(handler):
+    """Number of arguments handler takes, not counting self"""
+    arguments = inspect.getargspec(handler).args
+    if inspect.ismethod(handler):
+        arguments = arguments[1:]
+    return len(arguments)
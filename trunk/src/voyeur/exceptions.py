@@ -17,6 +17,9 @@ class SerialException(VoyeurException):
         self.path = path
         self.msg = msg
 
+    def __str__(self):
+        return '%s: %s' % (self.path, self.msg)
+
 class ProtocolException(VoyeurException):
     """Exception raised for errors in the protocol.
 
@@ -29,6 +32,21 @@ class ProtocolException(VoyeurException):
         self.protocol = protocol
         self.msg = msg
         
+class PersistorException(VoyeurException):
+    """Exception raised for errors writing the data file.
+
+    Attributes:
+        node -- name of the node that could not be written
+        msg  -- explanation of the error
+    """
+
+    def __init__(self, node, msg):
+        self.node = node
+        self.msg = msg
+
+    def __str__(self):
+        return '%s: %s' % (self.node, self.msg)
+
 class EndOfTrialException(VoyeurException):
     """Exception raised when end of trial occurs.
 
@@ -1,19 +1,23 @@
 import os, time
+import threading
 import getpass
-from traits.etsconfig.etsconfig import ETSConfig
-ETSConfig.toolkit = 'qt4'
-
-from voyeur.db import Persistor
-from voyeur.arduino import SerialPort, SerialCallThread
+from collections import deque
+from voyeur import db
+from voyeur.db import Persistor, PersistorThread, FlushPolicy, LAYOUTS
+from voyeur.arduino import SerialPort, SerialCallThread, StreamPlan, configured_boards, CAPABILITY_PUSH
+from voyeur.buffers import HandoffBuffer, POLICIES, merge_streams
+from voyeur.clock import ClockSync, monotonic
+from voyeur.display import DisplayBuffer
+from voyeur.eventloop import WorkerThread, Timer, on_ui_event
+from voyeur.engine import SerialEngine, EngineChannel
 from voyeur.exceptions import (
     EndOfTrialException,
     SerialException,
     ProtocolException,
-    NonOperationException
+    NonOperationException,
+    PersistorException
     )
-    
-from PyQt4.QtCore import QThread, QTimer
-from PyQt4.Qt import  QApplication
+
 from traits.api import (
     HasTraits,
     Instance,
@@ -22,17 +26,25 @@ from traits.api import (
     Int,
     Float,
     File,
+    Enum,
     Event,
+    List,
     on_trait_change
     )
 
 
-class AcquisitionThread(QThread):
+class AcquisitionThread(WorkerThread):
+
+    # Additional controller board acquired by this thread, None for the trial controller (board1)
+    board = None
 
     def acquire_stream(self):
         try:
             #print "Acquiring stream: "
-            self.monitor.acquire_stream()
+            if self.board is None:
+                self.monitor.acquire_stream()
+            else:
+                self.monitor.acquire_board_stream(self.board)
             #print "Acquired stream"
         except EndOfTrialException:
             self.monitor.eot = True
@@ -53,18 +65,135 @@ class AcquisitionThread(QThread):
             pass # Windows
 
         # acquisition loop
+        if self.board is None:
+            ready = self.monitor._wait_for_stream
+        else:
+            ready = self.board.ready.wait
         while self.monitor.running:
             #print "Stream thread tryin to enqueue", time.clock()
-            self.serial_queue.enqueue(self.acquire_stream)
+            if ready(0.5):
+                self.serial_queue.enqueue(self.acquire_stream)
+
+
+class Board(object):
+    """
+    An additional controller board, acquired in parallel with the trial controller (board1).
+
+    Each board has its own serial port, serial thread and acquisition thread, and streams
+    continuously while acquisition runs; trials are started and ended by board1 only. Its
+    stream names are prefixed with the board name, in the data file and in the streams passed
+    to the protocol, and every stream packet is tagged with the board number (db.BOARD) next to
+    its receive time (db.HOST_TIME), so the packets of all boards can be ordered.
+    """
+
+    def __init__(self, name, serial, monitor):
+        self.name = name
+        self.number = int(name[len('board'):])
+        self.serial = serial
+        self.serial_queue = SerialCallThread(monitor=monitor, max_queue_size=1)
+        self.acquisition_thread = None
+        # compiled protocol.board_stream_definition(name), None if the board is not acquired
+        self.stream_plan = None
+        # set while stream_plan is not None
+        self.ready = threading.Event()
+
+    def stream_name(self, key):
+        """Name of the board's stream key in the data file"""
+        if key == db.HOST_TIME:
+            return key
+        return self.name + '_' + key
+
+    def tag(self, stream):
+        """Renames the streams of a packet with stream_name() and tags it with the board number"""
+        tagged = dict((self.stream_name(key), value) for key, value in stream.iteritems())
+        tagged[db.BOARD] = self.number
+        return tagged
+
+    def update_stream_plan(self, stream_definition):
+        if not stream_definition:
+            self.ready.clear()
+            self.stream_plan = None
+        else:
+            if self.stream_plan is None or not self.stream_plan.matches(stream_definition):
+                self.stream_plan = StreamPlan(stream_definition)
+            self.ready.set()
+
+
+class StagedTrial(object):
+    """
+    A trial prepared ahead of its start: its parameters and stream definitions from the protocol,
+    its trial group and its packed start command.
+    """
+
+    def __init__(self, parameters, stream_definition, board_definitions, group, command):
+        self.parameters = parameters
+        self.stream_definition = stream_definition
+        # {Board => stream definition of the board, None if it is not acquired}
+        self.board_definitions = board_definitions
+        self.group = group
+        self.command = command
+
+
+class RealtimeController(object):
+    """
+    Sends controller commands from the protocol's realtime hooks (IProtocol.realtime_stream and
+    realtime_event), which run on the serial thread of board1 as soon as data is decoded.
+
+    Measures the host loop latency of each command: the time from the receipt of the stream
+    packet or event that triggered it (its db.HOST_TIME) to the controller's acknowledgement.
+    """
+
+    def __init__(self, serial):
+        self.serial = serial
+        # receive time of the data passed to the running hook
+        self.trigger_time = None
+        self.reset()
+
+    def reset(self):
+        """Starts measuring the latencies of a trial anew"""
+        self.commands = 0
+        self.latency = None
+        self.latency_max = 0.0
+        self._latency_total = 0.0
+
+    def send_command(self, command):
+        """Sends a user command to board1 immediately. Returns True if the controller acknowledged it."""
+        sent = self.serial.user_def_command(command)
+        if self.trigger_time is not None:
+            self.latency = monotonic() - self.trigger_time
+            self.latency_max = max(self.latency_max, self.latency)
+            self._latency_total += self.latency
+            self.commands += 1
+        return sent
+
+    def statistics(self):
+        """Number of commands and their mean and maximum loop latency (s) since reset()"""
+        if not self.commands:
+            return {'realtimeCommands': 0}
+        return {'realtimeCommands': self.commands,
+                'realtimeLatencyMean': self._latency_total / self.commands,
+                'realtimeLatencyMax': self.latency_max}
 
 
 class Monitor(HasTraits):
     """Central manager for CPU-side of Voyeur system"""
 
     # Client
-    persistor = Instance(object, factory=Persistor)
+    persistor = Instance(object)
+    # Number of stream packets and events queued for the persistor thread before acquisition blocks
+    persistor_queue_size = Int(1000)
+    # When buffered stream packets are flushed to disk. None uses the [persistor] section of the config file.
+    persistor_flush_policy = Instance(FlushPolicy)
+    # Stream array layout of the HDF5 file, per-trial VLArrays or session-wide EArrays.
+    # None uses the [persistor] section of the config file.
+    persistor_layout = Enum(None, *LAYOUTS)
     serial1 = Instance(object) #, factory=SerialPort, args=(os.environ['VOYEUR_CONFIG'], 'board1', 'port1'))
     serial_queue1 = Instance(object)
+    # How serial ports are served: an acquisition thread and a serial thread per port, or one
+    # SerialEngine thread for all ports. Set at construction.
+    acquisition_engine = Enum('threads', 'engine')
+    # Additional controller boards (board2, ...) configured with a serial port, see Board
+    boards = List(Instance(Board))
     protocol = Instance(object)
     database_file = File(None)
     user = Str(getpass.getuser())
@@ -87,31 +216,101 @@ class Monitor(HasTraits):
     paused = Bool(False)
     eot = Event() # queue for dispatch on ui thread
     push_event = Event() # dispatch immediately on ui thread
-    push_streaming = Event() # dispatch immediately on ui thread
+    push_streaming = Event() # dispatch immediately on ui thread, streams are taken from _stream_buffer
+    # Number of stream packets waiting for the ui thread before stream_backpressure applies
+    stream_buffer_size = Int(1)
+    # What the serial thread does when the ui thread falls stream_buffer_size packets behind:
+    # block until the ui catches up, drop the oldest packet or coalesce packets into one
+    stream_backpressure = Enum(*POLICIES)
+    # Batches per second the ui thread passes to protocol.process_stream_batch, 0 to pass every
+    # packet to protocol.process_stream_request. Batched packets collect without backpressure until
+    # the next batch, so the serial thread never waits for the ui thread.
+    stream_batch_hz = Float(0)
+    # How stream packets are acquired: requested one at a time, or pushed by the controller
+    # during the trial without requests. Push mode needs controller code reporting CAPABILITY_PUSH
+    # (see docs/sphinx/serial_protocol.rst), start_acquisition raises SerialException otherwise.
+    stream_mode = Enum('request', 'push')
+    # Milliseconds between pushed stream packets, 0 for the controller's default
+    stream_push_interval_ms = Int(0)
+    # Scalar stream holding the controller time in ms (e.g. 'packet_sent_time'). If set, the offset
+    # between controller and host clock is estimated and stored in each trial's clockOffset attribute.
+    clock_sync_stream = Str('')
+    # Plot refreshes per second when streams are displayed through display instead of passed
+    # to protocol.process_stream_request one packet at a time, 0 for per-packet processing
+    display_refresh_hz = Float(0)
+    # Decimated display buffers of the streams, a default DisplayBuffer if not set and
+    # display_refresh_hz > 0. Only the persistor receives the full-rate streams.
+    display = Instance(DisplayBuffer)
+    # Pass the streams and events of board1 to protocol.realtime_stream / realtime_event on the
+    # serial thread before anything else is done with them. Commands the hooks send through
+    # realtime_controller bypass the ui thread, their loop latency is stored with each trial.
+    realtime = Bool(False)
+    realtime_controller = Instance(RealtimeController)
+    # Prepare each trial (parameters, trial group, start command) during the inter-trial interval
+    # of the previous one, so only the start command is sent when the interval ends. The protocol's
+    # trial_parameters() is then called at the start of the interval instead of its end.
+    prestage_trials = Bool(False)
+    # Milliseconds the inter-trial interval timer fires before the next trial's start deadline, to
+    # prepare the trial and wake up the serial thread, which sends the start command at the deadline
+    iti_lead_ms = Int(50)
     current_session_group = Instance(object)
     current_trial_group = Instance(object)
     current_trial_parameters = Instance(object)
     acquisition_thread = Instance(AcquisitionThread)
-    _iti_timer = Instance(QTimer)
+    # compiled protocol.stream_definition(), rebuilt when the definition changes
+    stream_plan = Instance(StreamPlan)
+    _iti_timer = Instance(Timer)
+    # Monotonic time the next trial is scheduled to start at, None if no start is scheduled
+    _iti_deadline = None
+    # Monotonic time the current trial was scheduled to start at
+    _trial_intended_start = None
+    _display_timer = Instance(Timer)
+    _batch_timer = Instance(Timer)
+    # Set while a batch delivery is queued or scheduled on the ui thread
+    _batch_pending = False
+    # Stream packets waiting for the next batch delivery
+    _batch_streams = None
+    # monotonic time of the last batch delivery
+    _last_batch = 0.0
+    # display.updates at the last protocol.update_display call
+    _display_updates = 0
     processed = 0
     acquired = 0
-    _acquiringlock = False
+    _stream_buffer = Instance(HandoffBuffer)
     _eventlock = False
+    # Set while the acquisition thread should read streams (always in request mode)
+    _stream_ready = Instance(object)
+    # The next trial, prepared during the inter-trial interval
+    _staged_trial = Instance(StagedTrial)
+    # The parameters of the trial staged when acquisition was paused, staged again on unpause
+    _paused_parameters = Instance(object)
 
     def __init__(self, send_trial_number = False, *args, **kwargs):
         HasTraits.__init__(self, *args, **kwargs)
         
-        # events -- dispatched on UI thread
-        self.on_trait_event(self._handle_push_event, 'push_event', dispatch='fast_ui')
-        self.on_trait_event(self._handle_push_streaming, 'push_streaming', dispatch='fast_ui')
-        self.on_trait_change(self._handle_eot, 'eot', dispatch='ui')
+        # events -- dispatched on UI thread (the event loop thread when headless)
+        on_ui_event(self, self._handle_push_event, 'push_event')
+        on_ui_event(self, self._handle_push_streaming, 'push_streaming')
+        on_ui_event(self, self._handle_eot, 'eot', fast=False)
 
-        # database
-        self.persistor = Persistor()
+        # serial thread -> ui thread stream handoff
+        self._stream_buffer = HandoffBuffer(maxsize=self.stream_buffer_size,
+                                            policy=self.stream_backpressure,
+                                            coalesce=merge_streams)
+        self._batch_streams = deque()
+        self._stream_ready = threading.Event()
+        if self.stream_mode == 'request':
+            self._stream_ready.set()
 
         # config
         self.configFile = os.environ.get("VOYEUR_CONFIG")
 
+        # database -- written on the persistor thread
+        self.persistor = PersistorThread(Persistor.from_config(self.configFile,
+                                                               flush_policy=self.persistor_flush_policy,
+                                                               layout=self.persistor_layout),
+                                         max_queue_size=self.persistor_queue_size)
+
         # serial
         self.serial_queue1 = SerialCallThread(monitor=self, max_queue_size=1)        
         try:
@@ -121,7 +320,32 @@ class Monitor(HasTraits):
             print('Serial Port 1 Error')
             print('Serial exception. Message: ', e.msg, ' Path: ', e.path)
 
+        for board, port in configured_boards(self.configFile):
+            if board == 'board1':
+                continue
+            try:
+                serial = SerialPort(self.configFile, board=board, port=port)
+            except SerialException as e:
+                print('Serial Port ' + port + ' Error')
+                print('Serial exception. Message: ', e.msg, ' Path: ', e.path)
+                continue
+            self.boards.append(Board(board, serial, self))
+
+        if self.acquisition_engine == 'engine':
+            self._create_engine()
+
+        if self.serial1 is not None:
+            self.realtime_controller = RealtimeController(self.serial1)
+
+        if self.clock_sync_stream:
+            self.serial1.clock_sync = ClockSync(self.clock_sync_stream)
+            for board in self.boards:
+                board.serial.clock_sync = ClockSync(self.clock_sync_stream)
+
         self.protocol_name = self.serial1.request_protocol_name()
+        if self.stream_mode == 'push':
+            # before the serial threads use the port
+            self.serial1.request_capabilities()
         ### Define monitor metadata. This metadata is consistent between all protocols.
         self.metadata = {'arduino_protocol_name': self.protocol_name,
                          'start_date': time.mktime(time.localtime()),
@@ -163,13 +387,19 @@ class Monitor(HasTraits):
                                         new.event_definition(),
                                         self.current_session_group,
                                         '')"""
-        pass
+        self.stream_plan = None
+        self._discard_staged_trial()
+        self._paused_parameters = None
                                     
 
     def start_acquisition(self):
+        if self.stream_mode == 'push':
+            # raises SerialException before anything starts if the controller cannot push
+            self.serial1.require(CAPABILITY_PUSH, 'push mode streaming')
         self.running = True
         self.recording = True
         self.paused = False
+        self._start_display_timer()
         self.start_new_trial()
 
     def stop_acquisition(self):
@@ -178,17 +408,26 @@ class Monitor(HasTraits):
             self._iti_timer.stop()
             self._iti_timer.deleteLater()
             self._iti_timer = None
+        self._iti_deadline = None
+        if self._display_timer:
+            self._display_timer.stop()
+        if self._batch_timer:
+            self._batch_timer.stop()
+        self._batch_pending = False
+        self._batch_streams.clear()
         self.recording = False
-        self.running = False
         self.paused = False
-        self.setup_complete = False
+        self._discard_staged_trial()
+        self._paused_parameters = None
+        self._stop_push_streaming()
         if self.serial1 != None:
-            self._eventlock = True
-            self.serial_queue1.enqueue(self.serial1.end_trial)
-            self._eventlock = False
+            # while running, so the serial thread is still there to take it off its queue
+            self._enqueue_serial(self.serial1.end_trial)
             #self.serial_queue1.enqueue(self.persistor.close_database)
             #self.serial_queue1.enqueue(self.serial1.close)
-        self.persistor.close_database()
+        self.running = False
+        self.setup_complete = False
+        self._persist(self.persistor.close_database)
 
     def pause_acquisition(self, graceful = False):
         """Pauses acquisition"""
@@ -197,12 +436,17 @@ class Monitor(HasTraits):
             self._iti_timer.stop()
             self._iti_timer.deleteLater()
             self._iti_timer = None
+        self._iti_deadline = None
+        # unpausing stages the next trial anew with the same parameters: trial_parameters() may
+        # advance the protocol, so it is not asked again
+        if self._staged_trial is not None:
+            self._paused_parameters = self._staged_trial.parameters
+        self._discard_staged_trial()
         
         if graceful:
+            self._stop_push_streaming()
             if self.serial1 != None:
-                self._eventlock = True
-                self.serial_queue1.enqueue(self.serial1.end_trial)
-                self._eventlock = False
+                self._enqueue_serial(self.serial1.end_trial)
         if self.running:
             self.recording = False
                 
@@ -214,15 +458,25 @@ class Monitor(HasTraits):
             self.start_new_trial()
                
             
-    def send_command(self, command):
-        """ Sends a user command to arduino """
-        
-        if not self.serial_queue1.isRunning():
-            self.serial_queue1.start()
+    def send_command(self, command, board=None):
+        """
+        Sends a user command to arduino
+
+        board is the name of an additional board to send the command to instead of board1.
+        """
+        if board is not None and board != 'board1':
+            for additional in self.boards:
+                if additional.name == board:
+                    if self.acquisition_engine == 'engine':
+                        self._start_serial_queue()
+                    else:
+                        additional.serial_queue = additional.serial_queue.restarted()
+                    additional.serial_queue.enqueue(additional.serial.user_def_command, command)
+            return
+
+        self._start_serial_queue()
         if self.serial1 != None:
-            self._eventlock = True
-            self.serial_queue1.enqueue(self.serial1.user_def_command, command)
-            self._eventlock = False
+            self._enqueue_serial(self.serial1.user_def_command, command)
             """if not sent:
                 raise ProtocolException(self.protocol.protocol_description(),
                                          "Sending user defined command failed")"""
@@ -231,26 +485,69 @@ class Monitor(HasTraits):
         """Start New Trial"""
         # Get parameters for next trial
         if self.running and self.recording:
-            trial_parameters = self.protocol.trial_parameters()
-            # Create the trial group
-            self.current_trial_group = self.persistor.add_trial(self.protocol.trialNumber,
-                                                                trial_parameters.protocolParameters,
-                                                                trial_parameters.controllerParameters,
-                                                                self.protocol.stream_definition(),
-                                                                self.current_session_group,
-                                                                self.protocol.protocol_description())
+            trial = self._staged_trial or self._stage_trial(self._paused_parameters)
+            self._staged_trial = None
+            self._paused_parameters = None
+            if trial is None:
+                return
+            # trials started without a schedule (the first, or after a pause) start now
+            deadline = self._iti_deadline
+            self._iti_deadline = None
+            self._trial_intended_start = monotonic() if deadline is None else deadline
+            self._update_stream_plan(trial.stream_definition)
+            for board, definition in trial.board_definitions.items():
+                board.update_stream_plan(definition)
+            self.current_trial_group = trial.group
 
+            if self.realtime_controller is not None:
+                self.realtime_controller.reset()
             self.protocol.start_of_trial()
-            self._start_acquisition(trial_parameters.controllerParameters)
-            
-            if not self.serial_queue1.isRunning():
-                self.serial_queue1.start()
+            # started first: a call the last run left in the one-slot queue would block the start call
+            started = self._start_serial_queue()
+            self._start_acquisition(trial.parameters.controllerParameters, trial.command, deadline)
+            if started and self.acquisition_engine == 'threads':
                 self._start_acquisition_thread()
+            self._start_board_threads()
+
+    def _stage_trial(self, trial_parameters=None):
+        """
+        Prepares the next trial: gets its parameters from the protocol unless they are given, creates
+        its trial group and packs its start command. Returns a StagedTrial, or None if the protocol has
+        no next trial.
+        """
+        if trial_parameters is None:
+            trial_parameters = self.protocol.trial_parameters()
+        if trial_parameters is None:
+            return None
+        stream_definition = self.protocol.stream_definition()
+        board_definitions = dict((board, self.protocol.board_stream_definition(board.name))
+                                 for board in self.boards)
+        # Create the trial group
+        group = self.persistor.add_trial(self.protocol.trialNumber,
+                                         trial_parameters.protocolParameters,
+                                         trial_parameters.controllerParameters,
+                                         self._trial_stream_definition(stream_definition, board_definitions),
+                                         self.current_session_group,
+                                         self.protocol.protocol_description())
+        command = None
+        if self.serial1 is not None:
+            command = self.serial1.trial_command(trial_parameters.controllerParameters)
+        return StagedTrial(trial_parameters, stream_definition, board_definitions, group, command)
+
+    def _discard_staged_trial(self):
+        """Removes the trial group of a staged trial that will not run"""
+        if self._staged_trial is not None:
+            self.persistor.discard_trial(self._staged_trial.group)
+            self._staged_trial = None
 
     def acquire_events(self):
         """Run event acquisition"""
         event = self.serial1.request_event(self.protocol.event_definition())
         if event:
+            if self.realtime:
+                self._run_realtime(self.protocol.realtime_event, event)
+            self._persist(self.persistor.end_trial, self.current_trial_group, self._trial_statistics())
+            self._persist(self.persistor.insert_event, dict(event), self.current_session_group)
             self.push_event = (event, self.recording)
         else:
             raise ProtocolException(self.protocol.protocol_description(), "Event is null")
@@ -259,11 +556,17 @@ class Monitor(HasTraits):
     def acquire_stream(self):
         """Run stream acquisition"""      
         try:
-            stream = self.serial1.request_stream(self.protocol.stream_definition())
+            if self.stream_plan is None:
+                self._update_stream_plan(self.protocol.stream_definition())
+            if self.stream_mode == 'push':
+                stream = self.serial1.read_stream(self.stream_plan)
+                if not stream and not self.serial1.streaming:
+                    self._stream_ready.clear()
+            else:
+                stream = self.serial1.request_stream(self.stream_plan)
             #print "Stream acquired from serial: ", stream
             if stream:
-                self._acquiringlock = True
-                self.push_streaming = (stream, self.recording)
+                self._push_stream(stream)
                 self.acquired += 1
                 #print "Total streams acquired: ", self.acquired
             else:
@@ -272,43 +575,269 @@ class Monitor(HasTraits):
         except NonOperationException:
             raise ProtocolException(self.protocol.protocol_description(), "NonOperationException.")
         except EndOfTrialException as ex:
+            if self.stream_mode == 'push':
+                self._stream_ready.clear()
             stream = ex.last_read
             if stream:
-                self._acquiringlock = True
-                self.push_streaming = (stream, self.recording)
+                self._push_stream(stream)
                 #self.acquired += 1
                 #print "Total streams acquired: ", self.acquired
             raise ex
-        while(self._acquiringlock):
-            if self.running == False or self._eventlock:
-                break
-            continue
         return
+
+    def acquire_board_stream(self, board):
+        """Run stream acquisition of an additional board"""
+        try:
+            stream = board.serial.request_stream(board.stream_plan)
+        except EndOfTrialException as ex:
+            # trials are ended by board1 only
+            stream = ex.last_read
+        if stream:
+            self._push_stream(board.tag(stream))
+
+    def _create_engine(self):
+        """Serves the serial ports of all boards with one SerialEngine, which replaces their serial queues"""
+        engine = SerialEngine(monitor=self)
+        engine.add_channel(EngineChannel(self.serial1, self._engine_stream_plan,
+                                         lambda: self.stream_mode == 'push',
+                                         self._deliver_stream, self._deliver_end_of_trial))
+        for board in self.boards:
+            board.serial_queue = engine
+            engine.add_channel(EngineChannel(board.serial, lambda board=board: board.stream_plan,
+                                             lambda: False,
+                                             lambda stream, board=board: self._push_stream(board.tag(stream))))
+        self.serial_queue1 = engine
+
+    def _engine_stream_plan(self):
+        """Stream plan of board1 while streams should be read, else None"""
+        if self._stream_ready.is_set():
+            return self.stream_plan
+        return None
+
+    def _deliver_stream(self, stream):
+        """Takes a stream packet of board1 read by the SerialEngine"""
+        self._push_stream(stream)
+        self.acquired += 1
+
+    def _deliver_end_of_trial(self, stream):
+        """Takes the last stream packet of a trial read by the SerialEngine"""
+        if self.stream_mode == 'push':
+            self._stream_ready.clear()
+        if stream:
+            self._push_stream(stream)
+        self.eot = True
+
+    def _push_stream(self, stream):
+        """
+        Queues a stream for the persistor thread and hands it over to the ui thread.
+        The ui handoff blocks, drops or coalesces according to stream_backpressure, except for
+        batched streams, which are collected until the next batch.
+        """
+        if db.BOARD not in stream:
+            # a board1 packet
+            if self.realtime:
+                self._run_realtime(self.protocol.realtime_stream, stream)
+            if self._acquired_boards():
+                stream[db.BOARD] = 1
+        if self.running and self.recording:
+            # a copy: the protocol may change the stream on the ui thread while it is written
+            self._persist(self.persistor.insert_stream, dict(stream), self.current_trial_group)
+        if self._displaying():
+            if self.running:
+                self.display.add(stream)
+            return
+        if self.stream_batch_hz > 0:
+            self._batch_streams.append(stream)
+            # one delivery at a time is queued on the ui thread, however many packets arrive
+            if self._batch_pending:
+                return
+            self._batch_pending = True
+        else:
+            self._stream_buffer.put(stream, abort=self._stream_handoff_aborted)
+        self.push_streaming = True
+
+    def _persist(self, fn, *args):
+        """Calls a persistor method, reporting data file errors instead of stopping acquisition"""
+        try:
+            return fn(*args)
+        except PersistorException as e:
+            print 'Data file error: ', e
+
+    def _run_realtime(self, hook, data):
+        """Runs a realtime hook of the protocol on data just received from board1"""
+        controller = self.realtime_controller
+        controller.trigger_time = data.get(db.HOST_TIME)
+        try:
+            hook(data, controller)
+        finally:
+            controller.trigger_time = None
+
+    def _stream_handoff_aborted(self):
+        """A blocked stream handoff gives way when acquisition stops or the ui thread enqueues a serial call"""
+        return not self.running or self._eventlock
+
+    def _enqueue_serial(self, fn, *args, **kwargs):
+        """Enqueues fn on the serial thread from the ui thread, releasing a stream handoff blocked on the ui"""
+        self._enqueue_serial_at(None, fn, *args, **kwargs)
+
+    def _enqueue_serial_at(self, deadline, fn, *args, **kwargs):
+        """Like _enqueue_serial, to run fn at monotonic time deadline (as soon as possible if None)"""
+        self._eventlock = True
+        self._stream_buffer.wake()
+        self.serial_queue1.enqueue_at(deadline, fn, *args, **kwargs)
+        self._eventlock = False
+
+    def _running_changed(self):
+        if self._stream_buffer is not None:
+            self._stream_buffer.wake()
+
+    def _stream_mode_changed(self, new):
+        if self._stream_ready is not None and new == 'request':
+            self._stream_ready.set()
+
+    def _wait_for_stream(self, timeout):
+        """Waits until streams can be read, returns False if timeout seconds passed first"""
+        return self._stream_ready.wait(timeout)
+
+    def _stop_push_streaming(self):
+        """Stops the acquisition thread from reading pushed streams. end_trial stops the controller."""
+        if self.stream_mode == 'push':
+            self._stream_ready.clear()
+
+    def _displaying(self):
+        """True if streams go to the display buffers instead of the ui handoff"""
+        return self.display is not None and self.display_refresh_hz > 0
+
+    def _start_display_timer(self):
+        """Starts calling protocol.update_display at display_refresh_hz"""
+        if not self._displaying():
+            return
+        if self._display_timer is None:
+            self._display_timer = Timer()
+            self._display_timer.timeout.connect(self._refresh_display)
+        self._display_timer.start(max(1, int(1000 / self.display_refresh_hz)))
+
+    def _refresh_display(self):
+        """Lets the protocol redraw from the display buffers if streams arrived since the last redraw"""
+        if not self.running or self.protocol is None:
+            return
+        updates = self.display.updates
+        if updates != self._display_updates:
+            self._display_updates = updates
+            self.protocol.update_display(self.display)
+
+    def _display_refresh_hz_changed(self, new):
+        if new > 0 and self.display is None:
+            self.display = DisplayBuffer()
+        if self.running:
+            if new > 0:
+                self._start_display_timer()
+            elif self._display_timer is not None:
+                self._display_timer.stop()
+
+    def _stream_buffer_size_changed(self, new):
+        if self._stream_buffer is not None:
+            self._stream_buffer.maxsize = max(1, new)
+
+    def _stream_backpressure_changed(self, new):
+        if self._stream_buffer is not None:
+            self._stream_buffer.policy = new
                         
+    def _update_stream_plan(self, stream_definition):
+        """Compiles stream_definition unless the current stream plan was built from the same definition"""
+        if self.stream_plan is None or not self.stream_plan.matches(stream_definition):
+            self.stream_plan = StreamPlan(stream_definition)
+
+    def _acquired_boards(self):
+        """Additional boards with a stream definition for the current trial"""
+        return [board for board in self.boards if board.stream_plan is not None]
+
+    def _trial_stream_definition(self, stream_definition, board_definitions):
+        """
+        Stream definition of the trial group: board1's streams, plus the board column and the
+        streams of the additional boards with a definition in {Board => stream definition}
+        """
+        boards = [(board, definition) for board, definition in board_definitions.items() if definition]
+        if not boards:
+            return stream_definition
+        definition = dict(stream_definition)
+        definition[db.BOARD] = (0, 'int', db.Int16)
+        for board, board_definition in boards:
+            for key, value in board_definition.items():
+                definition[board.stream_name(key)] = value
+        return definition
+
+    def _trial_statistics(self):
+        """Acquisition counters of the trial, those of additional boards prefixed with the board name"""
+        statistics = self.serial1.trial_statistics()
+        if self.realtime:
+            statistics.update(self.realtime_controller.statistics())
+        for board in self._acquired_boards():
+            for key, value in board.serial.trial_statistics().items():
+                statistics[board.stream_name(key)] = value
+        return statistics
+
+    def _start_board_threads(self):
+        """Starts the serial and acquisition threads of additional boards that are not running"""
+        for board in self.boards:
+            board.serial.reset_trial_statistics()
+            if self.acquisition_engine == 'engine':
+                continue # served by serial_queue1
+            board.serial_queue = board.serial_queue.restarted()
+            if board.acquisition_thread is None or not board.acquisition_thread.isRunning():
+                board.acquisition_thread = AcquisitionThread()
+                board.acquisition_thread.serial_queue = board.serial_queue
+                board.acquisition_thread.monitor = self
+                board.acquisition_thread.board = board
+                board.acquisition_thread.start()
+
     def _handle_eot(self):
+        if self._batch_pending:
+            # the protocol gets the last streams of the trial before end_of_trial
+            if self._batch_timer is not None:
+                self._batch_timer.stop()
+            self._deliver_batch()
         self.protocol.end_of_trial()
-        self._eventlock = True
-        self.serial_queue1.enqueue(self.acquire_events)
-        self._eventlock = False
+        self._enqueue_serial(self.acquire_events)
 
-    def _run_iti(self, continuation):
+    def _run_iti(self, continuation, reference=None):
         """Starts a timer with Protocol-supplied inter-trial interval. Timer
         calls continuation when fired
         
+        The next trial is scheduled to start Protocol-supplied inter-trial interval after the
+        monotonic time reference (default: now), so the time taken to handle the events does not
+        add to the interval. The timer fires iti_lead_ms before that deadline.
+
         ITI timer is an object that can be modified and queried. To check if timer is active,
         use _iti_timer.is_active() method. To cancel timer, call _iti_timer.cancel() 
         """
         iti_ms = self.protocol.trial_iti_milliseconds()
         #print "next start iti = ", iti_ms
+        if reference is None:
+            reference = monotonic()
+        self._iti_deadline = reference + iti_ms / 1000.0
         if self._iti_timer:
             self._iti_timer.stop()
             self._iti_timer.deleteLater()
-        self._iti_timer = QTimer()
+        self._iti_timer = Timer()
         self._iti_timer.timeout.connect(continuation)
         self._iti_timer.setSingleShot(True)
-        self._iti_timer.start(iti_ms)
+        self._iti_timer.start(max(0, int((self._iti_deadline - monotonic()) * 1000) - self.iti_lead_ms))
         return
 
+    def _start_serial_queue(self):
+        """
+        Starts serial_queue1 (a new one if it finished, see SerialCallThread.restarted) unless it is
+        running. Returns True if it was started.
+        """
+        if self.serial_queue1.isRunning():
+            return False
+        self.serial_queue1 = self.serial_queue1.restarted()
+        if self.acquisition_engine == 'engine':
+            for board in self.boards:
+                board.serial_queue = self.serial_queue1
+        return True
+
     def _start_acquisition_thread(self):
         """Spawns the acquisition thread"""
         self.acquisition_thread = AcquisitionThread()
@@ -316,29 +845,69 @@ class Monitor(HasTraits):
         self.acquisition_thread.monitor = self
         self.acquisition_thread.start()
             
-    def _start_acquisition(self, trial_parameters):
+    def _start_acquisition(self, trial_parameters, command=None, deadline=None):
         """Starts acquisition. Called by AcquisitionThread.run"""
         if self.protocol != None:
-            self._eventlock = True
-            self.serial_queue1.enqueue(self.serial1.start_trial, trial_parameters)
-            self._eventlock = False
+            # the serial queue holds the start command until the deadline
+            self._enqueue_serial_at(deadline, self._start_serial_trial, trial_parameters, command)
+
+    def _start_serial_trial(self, trial_parameters, command=None):
+        """Starts the trial, and push mode streaming. Runs on the serial thread."""
+        self.serial1.start_trial(trial_parameters, command=command)
+        self._persist(self.persistor.set_trial_start, self._trial_intended_start, self.serial1.start_time)
+        if self.stream_mode == 'push':
+            self.serial1.start_streaming(self.stream_plan, self.stream_push_interval_ms)
+            self._stream_ready.set()
 
     def _handle_push_event(self, event_tuple):
         event, persist = event_tuple
-        self.persistor.insert_event(event, self.current_session_group)
         self.protocol.process_event_request(event)
         if not self.paused:
-            self._run_iti(self.start_new_trial)
+            # the interval starts when the events of the trial were received
+            self._run_iti(self.start_new_trial, event.get(db.HOST_TIME))
+            if self.prestage_trials and self.running and self.recording:
+                self._staged_trial = self._stage_trial()
 
-    def _handle_push_streaming(self, streaming_tuple):
+    def _handle_push_streaming(self):
+        if self.stream_batch_hz > 0:
+            self._schedule_batch()
+            return
         #print "processing stream....", time.clock()
+        # packets batched before stream_batch_hz was set to 0 go first
+        self._batch_pending = False
+        streams = self._take_batch() + self._stream_buffer.get_all()
         if not self.running:
             return
-        stream, persist = streaming_tuple
-        if persist:
-            self.persistor.insert_stream(stream, self.current_trial_group)
-        self.protocol.process_stream_request(stream)
-        self.processed += 1
+        for stream in streams:
+            self.protocol.process_stream_request(stream)
+            self.processed += 1
         #print "stream processed: ", time.clock(), ". Total processed: ", self.processed
-        self._acquiringlock = False        
-        return
\ No newline at end of file
+        return
+
+    def _schedule_batch(self):
+        """Delivers the buffered streams now, or once 1 / stream_batch_hz seconds passed since the last batch"""
+        wait = self._last_batch + 1.0 / self.stream_batch_hz - monotonic()
+        if wait <= 0:
+            self._deliver_batch()
+            return
+        if self._batch_timer is None:
+            self._batch_timer = Timer()
+            self._batch_timer.setSingleShot(True)
+            self._batch_timer.timeout.connect(self._deliver_batch)
+        self._batch_timer.start(int(wait * 1000) + 1)
+
+    def _deliver_batch(self):
+        self._batch_pending = False
+        self._last_batch = monotonic()
+        streams = self._take_batch()
+        if not self.running or not streams:
+            return
+        self.protocol.process_stream_batch(streams)
+        self.processed += len(streams)
+
+    def _take_batch(self):
+        """Removes and returns the stream packets collected for the next batch, oldest first"""
+        streams = []
+        while self._batch_streams:
+            streams.append(self._batch_streams.popleft())
+        return streams
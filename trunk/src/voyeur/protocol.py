@@ -150,6 +150,19 @@ class IProtocol(IPlugin):
         """
         pass
 
+    def process_stream_batch(self, streams):
+        """
+        Process the stream data acquired since the last batch.
+
+        Called instead of process_stream_request when the Monitor's stream_batch_hz is set, at most
+        stream_batch_hz times per second. Passes each stream to process_stream_request by default.
+
+        Parameters:
+            streams : list of streams that match stream_definition(), oldest first
+        """
+        for stream in streams:
+            self.process_stream_request(stream)
+
     @abc.abstractmethod
     def end_of_trial(self):
         pass
@@ -161,6 +174,54 @@ class IProtocol(IPlugin):
 
         pass
 
+    def board_stream_definition(self, board):
+        """
+        Returns the {name => (index, arduinoType, db.Type)} stream definition of an additional
+        controller board (e.g. 'board2'), or None not to acquire streams from it.
+
+        Streams of additional boards are passed to process_stream_request with their names
+        prefixed by the board name (e.g. 'board2_sniff') and the board number in stream['board'].
+        """
+
+        return None
+
+    def realtime_stream(self, stream, controller):
+        """
+        Closed-loop hook for stream data, run on the serial thread as soon as a packet of board1
+        is decoded, before it is stored or passed to process_stream_request.
+
+        Called only when the Monitor's realtime setting is on. It must return quickly, as the
+        next packet is not read before it returns, and must not touch the UI.
+
+        Parameters:
+            stream : stream that matches stream_definition()
+            controller : :class:`voyeur.monitor.RealtimeController`, sends commands to the
+                         controller immediately with controller.send_command(command)
+        """
+
+        pass
+
+    def realtime_event(self, event, controller):
+        """
+        Closed-loop hook for the event data of a trial, run on the serial thread as soon as it is
+        read, before it is stored or passed to process_event_request. See realtime_stream().
+        """
+
+        pass
+
+    def update_display(self, display):
+        """
+        Redraws plots from the Monitor's decimated stream buffers.
+
+        Called instead of process_stream_request when the Monitor's display_refresh_hz is set,
+        at most display_refresh_hz times per second and only if streams arrived since the last call.
+
+        Parameters:
+            display : :class:`voyeur.display.DisplayBuffer`, e.g. display.envelope('sniff')
+        """
+
+        pass
+
     def protocol_description(self):
         """A string description of the protocol"""
 
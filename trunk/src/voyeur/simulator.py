@@ -0,0 +1,456 @@
+import os
+import time
+import math
+import random
+import select
+import struct
+import threading
+import binascii
+from collections import deque
+import db
+from numpy import arange, sin, int16
+from voyeur.arduino import STREAM_DTYPES, CAPABILITY_PUSH, CAPABILITY_CHECKSUM, CAPABILITY_RETRANSMIT
+
+"""Hardware-free stand-in for the Arduino controller"""
+
+
+class SimulatedChannel(object):
+    """
+    A stream channel of the simulated controller.
+
+    Attributes:
+        name        -- key in the stream definition
+        index       -- stream index in the stream definition
+        arduinoType -- 'int', 'unsigned int', 'long' or 'unsigned long'
+        rate        -- samples per second. None sends a single value per packet.
+        signal      -- callable mapping an array of sample times (s) to sample values.
+                       Defaults to a 2 Hz sine for sampled channels and to the controller
+                       time in ms for single value channels.
+    """
+
+    def __init__(self, name, index, arduinoType='int', rate=1000.0, signal=None):
+        self.name = name
+        self.index = index
+        self.arduinoType = arduinoType
+        self.rate = rate
+        if signal is None:
+            if rate is None:
+                signal = lambda t: (t * 1000).astype('int64')
+            else:
+                signal = lambda t: (500 * sin(2 * math.pi * 2 * t)).astype(int16)
+        self.signal = signal
+
+    def kind(self):
+        """The db type a protocol would declare for this channel"""
+        if self.rate is None:
+            return db.Int
+        elif self.arduinoType in ('int', 'unsigned int'):
+            return db.Int16Array
+        return db.IntArray
+
+
+class SimulatedController(object):
+    """
+    Simulates an Arduino controller running a Voyeur protocol.
+
+    Implements the serial command set (chr(86) user command, chr(87) stream request, chr(88)
+    event request, chr(89) end trial, chr(90) start trial with packed parameters, chr(91) protocol
+    name, chr(92) force pin, chr(93) start and chr(94) stop push mode streaming, chr(95) retransmit,
+    chr(96) capabilities)
+    and replies with the handshake 1-7 packets SerialPort expects (see docs/sphinx/serial_protocol.rst). Commands are fed to feed(); replies are scheduled with a delivery
+    time and collected with read_ready().
+
+    In push mode a stream packet with a sequence number is sent every push interval until the end
+    of the trial. With extended_header every stream packet carries a sequence number and a
+    CRC-16/XMODEM checksum, and the last history packets can be retransmitted.
+
+    Arguments:
+        channels          -- list of SimulatedChannel, defaults to a 1 kHz sniff channel and a packet time
+        parameters_format -- struct format of the trial parameters sent with chr(90)
+        event_values      -- callable(trial) returning the list of event values sent with handshake 4
+        trial_duration    -- seconds from start trial until the end of trial is signalled
+        latency           -- seconds between a command and the controller's reply
+        jitter            -- maximum random seconds added to the latency
+        drop_rate         -- probability of dropping one byte of a binary stream packet
+        corrupt_rate      -- probability of flipping the bits of one byte of a binary stream packet
+        buffer_samples    -- samples per channel the controller buffers between stream requests.
+                             Older samples are discarded and counted in overflows.
+        baudrate          -- if set, replies are delayed by their transmission time
+        push_interval     -- default seconds between pushed stream packets
+        extended_header   -- send sequence numbers and checksums with every stream packet
+        history           -- number of sent stream packets kept for retransmission
+        legacy            -- simulate controller code without the chr(93) - chr(96) extensions
+                             (e.g. controller_ser), which ignores them like any unknown command
+    """
+
+    def __init__(self, channels=None, parameters_format='', protocol_name='simulator',
+                 event_values=None, trial_duration=2.0, latency=0.0, jitter=0.0, drop_rate=0.0,
+                 corrupt_rate=0.0, buffer_samples=None, baudrate=None, push_interval=0.01,
+                 extended_header=False, history=16, legacy=False, seed=None, clock=time.time):
+        if channels is None:
+            channels = [SimulatedChannel('packet_sent_time', 1, 'unsigned long', rate=None),
+                        SimulatedChannel('sniff', 2, 'int', rate=1000.0)]
+        self.channels = sorted(channels, key=lambda channel: channel.index)
+        self.parameters_format = parameters_format
+        self.parameters_size = struct.calcsize('=' + parameters_format)
+        self.protocol_name = protocol_name
+        self.event_values = event_values or (lambda trial: [trial, 1])
+        self.trial_duration = trial_duration
+        self.latency = latency
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.corrupt_rate = corrupt_rate
+        self.buffer_samples = buffer_samples
+        self.baudrate = baudrate
+        self.push_interval = push_interval
+        self.extended_header = extended_header
+        self.legacy = legacy
+        self.random = random.Random(seed)
+        self.clock = clock
+        self.start_time = clock()
+
+        self.trial = 0
+        self.in_trial = False
+        self.parameters = None
+        self.user_commands = []
+        # (pin, state) of the chr(92) force pin commands received
+        self.forced_pins = []
+        self.pushing = False
+        self.sequence = 0
+        # statistics
+        self.packets_sent = 0
+        self.bytes_dropped = 0
+        self.bytes_corrupted = 0
+        self.retransmissions = 0
+        self.overflows = 0
+
+        self._input = ''
+        self._output = []
+        self._last_delivery = 0
+        self._trial_start = None
+        self._sampled_until = None
+        self._interval = push_interval
+        self._next_push = None
+        self._history = deque(maxlen=history)
+        self._lock = threading.Lock()
+
+    def stream_definition(self):
+        """Stream definition matching the simulated channels"""
+        return dict((channel.name, (channel.index, channel.arduinoType, channel.kind()))
+                    for channel in self.channels)
+
+    def feed(self, data):
+        """Processes bytes written to the controller"""
+        with self._lock:
+            # packets pushed before the command arrived go out first
+            self._push(self.clock())
+            self._input += data
+            while self._input:
+                code = ord(self._input[0])
+                if code == 86:
+                    end = self._input.find('\r')
+                    if end < 0:
+                        return
+                    self.user_commands.append(self._input[1:end])
+                    self._input = self._input[end + 1:]
+                    self._reply("2,*\r\n")
+                elif code == 90:
+                    if len(self._input) < 1 + self.parameters_size:
+                        return
+                    packed = self._input[1:1 + self.parameters_size]
+                    self._input = self._input[1 + self.parameters_size:]
+                    self._start_trial(packed)
+                elif code == 92:
+                    # force pin: pin number and state bytes, no reply
+                    if len(self._input) < 3:
+                        return
+                    self.forced_pins.append((ord(self._input[1]), ord(self._input[2])))
+                    self._input = self._input[3:]
+                elif code == 93 and not self.legacy:
+                    if len(self._input) < 3:
+                        return
+                    interval_ms = struct.unpack('<H', self._input[1:3])[0]
+                    self._input = self._input[3:]
+                    self._start_pushing(interval_ms)
+                elif code == 95 and not self.legacy:
+                    if len(self._input) < 3:
+                        return
+                    sequence = struct.unpack('<H', self._input[1:3])[0]
+                    self._input = self._input[3:]
+                    self._retransmit(sequence)
+                else:
+                    self._input = self._input[1:]
+                    self._command(code)
+
+    def read_ready(self, now=None):
+        """Removes and returns the reply bytes whose delivery time has passed"""
+        if now is None:
+            now = self.clock()
+        with self._lock:
+            self._push(now)
+            ready = []
+            while self._output and self._output[0][0] <= now:
+                ready.append(self._output.pop(0)[1])
+            return ''.join(ready)
+
+    def next_delivery(self):
+        """Delivery time of the next scheduled reply, None if nothing is scheduled"""
+        with self._lock:
+            deliveries = [self._next_push] if self.pushing else []
+            if self._output:
+                deliveries.append(self._output[0][0])
+            if deliveries:
+                return min(deliveries)
+            return None
+
+    def reset_output(self):
+        """Discards all scheduled replies"""
+        with self._lock:
+            self._output = []
+
+    def _command(self, code):
+        if code == 87:
+            self._stream()
+        elif code == 88:
+            values = ','.join(str(value) for value in self.event_values(self.trial))
+            self._reply("4,%s,*\r\n" % values)
+        elif code == 89:
+            self.in_trial = False
+            self.pushing = False
+            self._reply("3,*\r\n")
+        elif code == 91:
+            self._reply("6,%s,*\r\n" % self.protocol_name)
+        elif self.legacy:
+            return
+        elif code == 96:
+            self._reply("7,%d,*\r\n" % self.capabilities())
+        elif code == 94:
+            self.pushing = False
+            self._reply("2,*\r\n")
+
+    def capabilities(self):
+        """CAPABILITY_* flags of the reply to chr(96)"""
+        flags = CAPABILITY_PUSH | CAPABILITY_RETRANSMIT
+        if self.extended_header:
+            flags |= CAPABILITY_CHECKSUM
+        return flags
+
+    def _start_trial(self, packed):
+        if self.parameters_size:
+            self.parameters = struct.unpack('=' + self.parameters_format, packed)
+        self.trial += 1
+        self.in_trial = True
+        self._trial_start = self.clock()
+        self._sampled_until = self._trial_start
+        self._reply("2,*\r\n")
+
+    def _start_pushing(self, interval_ms):
+        self._interval = interval_ms / 1000.0 if interval_ms else self.push_interval
+        self.pushing = True
+        self._next_push = self.clock() + self._interval
+
+    def _push(self, now):
+        """Sends the stream packets pushed until now"""
+        while self.pushing and self._next_push <= now:
+            self._stream(self._next_push, push=True)
+            self._next_push += self._interval
+            if not self.in_trial:
+                self.pushing = False
+
+    def _retransmit(self, sequence):
+        for sent_sequence, packet in self._history:
+            if sent_sequence == sequence:
+                self.retransmissions += 1
+                self._reply(packet)
+                return
+        self._reply("2,*\r\n")
+
+    def _stream(self, now=None, push=False):
+        if now is None:
+            now = self.clock()
+        if self._sampled_until is None:
+            self._sampled_until = now
+        eot = self.in_trial and now - self._trial_start >= self.trial_duration
+
+        streams = []
+        for channel in self.channels:
+            if channel.rate is None:
+                times = arange(1) * 0.0 + (now - self.start_time)
+            else:
+                first = int(math.ceil((self._sampled_until - self.start_time) * channel.rate))
+                last = int(math.ceil((now - self.start_time) * channel.rate))
+                if self.buffer_samples is not None and last - first > self.buffer_samples:
+                    self.overflows += 1
+                    first = last - self.buffer_samples
+                times = arange(first, last) / float(channel.rate)
+            values = channel.signal(times).astype(STREAM_DTYPES[channel.arduinoType])
+            streams.append(values.tostring())
+        self._sampled_until = now
+
+        payload = ''.join(streams)
+        header = "6,%i,%s" % (len(streams), ','.join(str(len(stream)) for stream in streams))
+        if push or self.extended_header:
+            sequence = self.sequence
+            self.sequence = (self.sequence + 1) % 65536
+            header += ",%i" % sequence
+            if self.extended_header:
+                header += ",%i" % binascii.crc_hqx(payload, 0)
+                self._history.append((sequence, header + ",*\r\n" + payload))
+        header += ",*"
+        if eot:
+            header += "5,*"
+            self.in_trial = False
+        if payload and self.drop_rate and self.random.random() < self.drop_rate:
+            position = self.random.randrange(len(payload))
+            payload = payload[:position] + payload[position + 1:]
+            self.bytes_dropped += 1
+        if payload and self.corrupt_rate and self.random.random() < self.corrupt_rate:
+            position = self.random.randrange(len(payload))
+            payload = payload[:position] + chr(ord(payload[position]) ^ 0xff) + payload[position + 1:]
+            self.bytes_corrupted += 1
+        self.packets_sent += 1
+        self._reply(header + "\r\n" + payload, now)
+
+    def _reply(self, data, now=None):
+        if now is None:
+            now = self.clock()
+        delivery = now + self.latency
+        if self.jitter:
+            delivery += self.random.uniform(0, self.jitter)
+        if self.baudrate:
+            delivery += len(data) * 10.0 / self.baudrate
+        # the serial line delivers replies in order
+        delivery = max(delivery, self._last_delivery)
+        self._last_delivery = delivery
+        self._output.append((delivery, data))
+
+
+class SimulatedSerial(object):
+    """
+    In-process stand-in for serial.Serial connected to a SimulatedController.
+
+    Supports the subset of the pyserial API used by :class:`voyeur.arduino.SerialPort`.
+    Pass it to SerialPort as serial_device.
+    """
+
+    def __init__(self, controller=None, timeout=1, name='simulator'):
+        if controller is None:
+            controller = SimulatedController()
+        self.controller = controller
+        self.timeout = timeout
+        self.name = name
+        self._rx = bytearray()
+        self._open = True
+
+    def write(self, data):
+        self.controller.feed(data)
+        return len(data)
+
+    def read(self, size=1):
+        """Reads size bytes, or fewer if the timeout expires first"""
+        self._wait_for(lambda: len(self._rx) >= size)
+        data = str(self._rx[:size])
+        del self._rx[:size]
+        return data
+
+    def readline(self):
+        """Reads up to and including '\\n', or what has arrived when the timeout expires"""
+        self._wait_for(lambda: '\n' in self._rx)
+        end = self._rx.find('\n')
+        if end < 0:
+            end = len(self._rx)
+        else:
+            end += 1
+        data = str(self._rx[:end])
+        del self._rx[:end]
+        return data
+
+    def inWaiting(self):
+        self._rx += self.controller.read_ready()
+        return len(self._rx)
+
+    @property
+    def in_waiting(self):
+        return self.inWaiting()
+
+    def flushInput(self):
+        self._rx = bytearray()
+        self.controller.reset_output()
+
+    reset_input_buffer = flushInput
+
+    def flushOutput(self):
+        pass
+
+    def open(self):
+        self._open = True
+
+    def close(self):
+        self._open = False
+
+    def isOpen(self):
+        return self._open
+
+    def _wait_for(self, condition):
+        """Collects replies until condition() holds or the timeout expires, sleeping until the next reply is due"""
+        clock = self.controller.clock
+        deadline = None
+        if self.timeout is not None:
+            deadline = clock() + self.timeout
+        self._rx += self.controller.read_ready()
+        while not condition():
+            now = clock()
+            next_delivery = self.controller.next_delivery()
+            if deadline is not None and now >= deadline:
+                return
+            if next_delivery is None:
+                # nothing will arrive unless another thread writes, so wait out the timeout
+                if deadline is None:
+                    return
+                time.sleep(deadline - now)
+            elif next_delivery > now:
+                wake = next_delivery if deadline is None else min(next_delivery, deadline)
+                time.sleep(wake - now)
+            self._rx += self.controller.read_ready()
+
+
+class PtyBridge(threading.Thread):
+    """
+    Serves a SimulatedController on a pseudo-terminal (POSIX only).
+
+    The path of the terminal is in the device attribute. Use it as the serial port in the Voyeur
+    config file to test the complete serial stack without hardware.
+    """
+
+    def __init__(self, controller=None):
+        threading.Thread.__init__(self, name='PtyBridge')
+        self.daemon = True
+        if controller is None:
+            controller = SimulatedController()
+        self.controller = controller
+        import tty # POSIX only, like the rest of the bridge
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave) # binary packets must pass the line discipline untouched
+        self.device = os.ttyname(self.slave)
+        self.running = False
+
+    def run(self):
+        self.running = True
+        while self.running:
+            timeout = 0.1
+            next_delivery = self.controller.next_delivery()
+            if next_delivery is not None:
+                timeout = min(timeout, max(0, next_delivery - self.controller.clock()))
+            readable, writable, errors = select.select([self.master], [], [], timeout)
+            if readable:
+                self.controller.feed(os.read(self.master, 4096))
+            ready = self.controller.read_ready()
+            while ready:
+                written = os.write(self.master, ready)
+                ready = ready[written:]
+
+    def stop(self):
+        self.running = False
+        self.join()
+        os.close(self.master)
+        os.close(self.slave)
@@ -0,0 +1,287 @@
+import os
+import time
+import traceback
+import multiprocessing
+from Queue import Empty, Full
+from numpy import ndarray
+from voyeur.buffers import merge_streams
+
+"""Process-per-rig supervisor"""
+
+# Messages from rig processes to the supervisor are (kind, rig name, payload) tuples
+STREAM = 'stream'   # payload: downsampled streams merged since the last stream message
+EVENT = 'event'     # payload: event dictionary of a trial
+STATUS = 'status'   # payload: dictionary of rig status values
+ERROR = 'error'     # payload: traceback of an exception that ended the rig process
+STOPPED = 'stopped' # payload: None, the rig process is about to exit
+
+# Commands from the supervisor to a rig process
+START = 'start'
+STOP = 'stop'
+PAUSE = 'pause'
+UNPAUSE = 'unpause'
+COMMAND = 'command' # argument: user command sent to the controller
+
+
+class RigSpec(object):
+    """
+    Describes the acquisition a rig process runs.
+
+    Everything is passed to the rig process, so the attributes must be picklable.
+
+    Attributes:
+        name            -- rig name, tags all messages of the rig
+        protocol        -- protocol class as 'package.module:ClassName', importable in the rig process
+        protocol_kwargs -- keyword arguments of the protocol class
+        config_file     -- Voyeur config file of the rig (serial ports, data file settings).
+                           Defaults to the VOYEUR_CONFIG environment variable.
+        database_file   -- HDF5 file the rig records to
+        monitor_traits  -- trait values of the rig's Monitor
+        downsample      -- array streams sent to the supervisor keep every downsample-th sample
+        send_interval   -- seconds between stream and status messages, streams are merged in between
+    """
+
+    def __init__(self, name, protocol, protocol_kwargs=None, config_file=None, database_file=None,
+                 monitor_traits=None, downsample=10, send_interval=0.05):
+        self.name = name
+        self.protocol = protocol
+        self.protocol_kwargs = protocol_kwargs or {}
+        self.config_file = config_file
+        self.database_file = database_file
+        self.monitor_traits = monitor_traits or {}
+        self.downsample = downsample
+        self.send_interval = send_interval
+
+
+class Supervisor(object):
+    """
+    Runs each rig's acquisition and persistence pipeline in its own process.
+
+    Rig processes inherit the environment, set ETS_TOOLKIT=null to run them headless.
+
+    Every rig process has its own Monitor, serial ports, persistor and Python interpreter, so
+    rigs do not contend for one GIL. The rig processes send downsampled streams, events and
+    status to one bounded message queue. Read it from the UI process with poll(). When the
+    queue is full, rig processes drop messages instead of waiting, so a slow UI never stalls
+    acquisition. Commands go to each rig over its own pipe.
+
+    Example::
+
+        supervisor = Supervisor([RigSpec('rig1', 'myprotocols.sniff:SniffProtocol',
+                                         config_file='rig1.conf', database_file='rig1_session1'),
+                                 RigSpec('rig2', 'myprotocols.sniff:SniffProtocol',
+                                         config_file='rig2.conf', database_file='rig2_session1')])
+        supervisor.start()
+        supervisor.start_acquisition()
+        # in a UI timer:
+        for kind, rig, payload in supervisor.poll():
+            ...
+        supervisor.stop()
+    """
+
+    def __init__(self, specs, queue_size=256):
+        self.specs = list(specs)
+        self.messages = multiprocessing.Queue(queue_size)
+        self.processes = {}
+        self.connections = {}
+
+    def start(self):
+        """Starts the rig processes. Acquisition starts with start_acquisition()."""
+        for spec in self.specs:
+            if spec.name in self.processes and self.processes[spec.name].is_alive():
+                continue
+            connection, rig_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=run_rig, name=spec.name,
+                                              args=(spec, rig_connection, self.messages))
+            process.daemon = True
+            process.start()
+            self.processes[spec.name] = process
+            self.connections[spec.name] = connection
+
+    def send(self, rig, command, *args):
+        """Sends command to the rig named rig, or to all rigs if rig is None"""
+        names = self.connections.keys() if rig is None else [rig]
+        for name in names:
+            if self.processes[name].is_alive():
+                self.connections[name].send((command, args))
+
+    def start_acquisition(self, rig=None):
+        self.send(rig, START)
+
+    def pause_acquisition(self, rig=None):
+        self.send(rig, PAUSE)
+
+    def unpause_acquisition(self, rig=None):
+        self.send(rig, UNPAUSE)
+
+    def send_command(self, command, rig=None):
+        """Sends a user defined controller command"""
+        self.send(rig, COMMAND, command)
+
+    def poll(self, timeout=0):
+        """Returns the messages available, waiting up to timeout seconds for the first one"""
+        messages = []
+        try:
+            if timeout:
+                messages.append(self.messages.get(True, timeout))
+            while True:
+                messages.append(self.messages.get_nowait())
+        except Empty:
+            pass
+        return messages
+
+    def alive(self):
+        """{rig name => True if the rig process is running}"""
+        return dict((name, process.is_alive()) for name, process in self.processes.items())
+
+    def stop(self, timeout=10.0):
+        """Stops acquisition and waits for the rig processes to exit, terminating them after timeout seconds"""
+        self.send(None, STOP)
+        deadline = time.time() + timeout
+        for name, process in self.processes.items():
+            process.join(max(0, deadline - time.time()))
+            if process.is_alive():
+                process.terminate()
+                process.join()
+            self.connections[name].close()
+        self.processes = {}
+        self.connections = {}
+
+
+class RigLink(object):
+    """
+    Rig process side of the supervisor channels.
+
+    Forwards the streams and events the protocol processes to the supervisor, downsampled and
+    merged between sends, and carries out the supervisor's commands. Both happen on the rig
+    process' UI thread, driven by a timer.
+    """
+
+    def __init__(self, spec, connection, messages, monitor):
+        self.spec = spec
+        self.connection = connection
+        self.messages = messages
+        self.monitor = monitor
+        self.dropped = 0
+        self.stopped = False
+        self._pending = None
+
+    def attach(self, protocol):
+        """Wraps the protocol's stream and event callbacks to also forward their data"""
+        process_stream_request = protocol.process_stream_request
+        process_event_request = protocol.process_event_request
+
+        def forward_stream(stream):
+            process_stream_request(stream)
+            self.add_stream(stream)
+
+        def forward_event(event):
+            process_event_request(event)
+            self.post(EVENT, event)
+
+        protocol.process_stream_request = forward_stream
+        protocol.process_event_request = forward_event
+
+    def add_stream(self, stream):
+        stream = downsample(stream, self.spec.downsample)
+        if self._pending is None:
+            self._pending = stream
+        else:
+            merged = merge_streams(self._pending, stream)
+            if merged is None:
+                self.post(STREAM, self._pending)
+                merged = stream
+            self._pending = merged
+
+    def post(self, kind, payload):
+        """Sends a message to the supervisor, dropping it if the message queue is full"""
+        try:
+            self.messages.put_nowait((kind, self.spec.name, payload))
+        except Full:
+            self.dropped += 1
+
+    def status(self):
+        monitor = self.monitor
+        status = {'running': monitor.running,
+                  'paused': monitor.paused,
+                  'acquired': monitor.acquired,
+                  'processed': monitor.processed,
+                  'dropped_messages': self.dropped}
+        if monitor.protocol is not None:
+            status['trial'] = getattr(monitor.protocol, 'trialNumber', None)
+        if monitor.serial1 is not None:
+            status.update(monitor.serial1.trial_statistics())
+        return status
+
+    def tick(self):
+        """Sends the pending streams and the status, and runs the commands received"""
+        if self._pending is not None:
+            self.post(STREAM, self._pending)
+            self._pending = None
+        self.post(STATUS, self.status())
+        while not self.stopped and self.connection.poll():
+            command, args = self.connection.recv()
+            self.run_command(command, args)
+
+    def run_command(self, command, args):
+        monitor = self.monitor
+        if command == START:
+            if self.spec.database_file and not monitor.database_file:
+                monitor.database_file = self.spec.database_file
+            monitor.start_acquisition()
+        elif command == PAUSE:
+            monitor.pause_acquisition(graceful=True)
+        elif command == UNPAUSE:
+            monitor.unpause_acquisition()
+        elif command == COMMAND:
+            monitor.send_command(*args)
+        elif command == STOP:
+            if monitor.running:
+                monitor.stop_acquisition()
+            self.stopped = True
+
+
+def run_rig(spec, connection, messages):
+    """Entry point of a rig process: runs a Monitor with the rig's protocol until told to stop"""
+    try:
+        if spec.config_file:
+            os.environ['VOYEUR_CONFIG'] = spec.config_file
+        from voyeur import eventloop
+        from voyeur.monitor import Monitor
+
+        # with Qt, the timers below and the Monitor's only fire once the QApplication exists
+        eventloop.init()
+        monitor = Monitor(**spec.monitor_traits)
+        protocol = load_class(spec.protocol)(**spec.protocol_kwargs)
+        link = RigLink(spec, connection, messages, monitor)
+        link.attach(protocol)
+        monitor.protocol = protocol
+
+        def tick():
+            link.tick()
+            if link.stopped:
+                timer.stop()
+                eventloop.quit()
+
+        timer = eventloop.Timer()
+        timer.timeout.connect(tick)
+        timer.start(int(spec.send_interval * 1000))
+        eventloop.run()
+    except Exception:
+        messages.put((ERROR, spec.name, traceback.format_exc()))
+    messages.put((STOPPED, spec.name, None))
+
+
+def load_class(path):
+    """Imports 'package.module:ClassName' and returns the class"""
+    module_name, class_name = path.split(':')
+    module = __import__(module_name, fromlist=[class_name])
+    return getattr(module, class_name)
+
+
+def downsample(stream, factor):
+    """Keeps every factor-th sample of the array values of stream"""
+    if factor <= 1:
+        return stream
+    return dict((key, value[::factor] if type(value) == ndarray else value)
+                for key, value in stream.iteritems())
@@ -0,0 +1,166 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import numpy
+import tables
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from voyeur import db
+from voyeur.db import Persistor, PersistorThread, FlushPolicy, SESSION_LAYOUT
+from voyeur.exceptions import PersistorException
+
+"""Persistor tests"""
+
+PROTOCOL_PARAMETERS = {'trialNumber': db.Int}
+CONTROLLER_PARAMETERS = {'iti': (1, db.Int)}
+EVENTS = {'response': (1, db.Int)}
+STREAMS = {'sniff': (1, 'int', db.Int16Array), 'count': (2, 'int', db.Int)}
+
+
+class PersistorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'session')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_session(self, persistor, trials=2, packets=25):
+        session = persistor.create_database(self.filename, {})
+        persistor.create_trials(PROTOCOL_PARAMETERS, CONTROLLER_PARAMETERS, EVENTS, session, '')
+        for trial in range(1, trials + 1):
+            group = persistor.add_trial(trial, {'trialNumber': trial}, {'iti': (1, db.Int, 100)},
+                                        STREAMS, session, '')
+            for packet in range(packets):
+                persistor.insert_stream({'sniff': numpy.arange(10, dtype=numpy.int16),
+                                         'count': packet,
+                                         db.HOST_TIME: float(packet)}, group)
+            persistor.end_trial(group)
+            persistor.insert_event({'response': trial}, session)
+        persistor.close_database()
+        return tables.open_file(self.filename + '.h5')
+
+
+class TestFlush(PersistorTestCase):
+
+    def test_row_counts(self):
+        h5file = self.write_session(Persistor(flush_policy=FlushPolicy(max_packets=10)))
+        try:
+            self.assertEqual(len(h5file.root.Trials), 2)
+            self.assertEqual(list(h5file.root.Trials.cols.response[:]), [1, 2])
+            for name in ('Trial0001', 'Trial0002'):
+                trial = h5file.root._f_get_child(name)
+                self.assertEqual(len(trial.Events), 25)
+                self.assertEqual(list(trial.Events.cols.count[:]), range(25))
+                self.assertEqual(len(trial.sniff), 25)
+        finally:
+            h5file.close()
+
+    def test_failed_flush_is_not_repeated(self):
+        persistor = Persistor(flush_policy=FlushPolicy(max_packets=10))
+        session = persistor.create_database(self.filename, {})
+        persistor.create_trials(PROTOCOL_PARAMETERS, CONTROLLER_PARAMETERS, EVENTS, session, '')
+        group = persistor.add_trial(1, {'trialNumber': 1}, {'iti': (1, db.Int, 100)}, STREAMS, session, '')
+        errors = 0
+        for packet in range(20):
+            stream = {'sniff': numpy.arange(10, dtype=numpy.int16), 'count': packet}
+            if packet == 3:
+                stream['unknown'] = numpy.arange(3)
+            try:
+                persistor.insert_stream(stream, group)
+            except PersistorException:
+                errors += 1
+        persistor.end_trial(group)
+        persistor.close_database()
+        self.assertEqual(errors, 1)
+        h5file = tables.open_file(self.filename + '.h5')
+        try:
+            self.assertEqual(len(h5file.root.Trial0001.Events), 20)
+            self.assertEqual(len(h5file.root.Trial0001.sniff), 20)
+        finally:
+            h5file.close()
+
+    def test_undeclared_stream_key(self):
+        """A stream key without an Events column fails its flush with a PersistorException, the writer thread goes on"""
+        persistor = PersistorThread(Persistor(flush_policy=FlushPolicy(max_packets=10)))
+        session = persistor.create_database(self.filename, {})
+        persistor.create_trials(PROTOCOL_PARAMETERS, CONTROLLER_PARAMETERS, EVENTS, session, '')
+        group = persistor.add_trial(1, {'trialNumber': 1}, {'iti': (1, db.Int, 100)}, STREAMS, session, '')
+        errors = []
+        def persist(fn, *args):
+            # the error of a queued write is raised by whichever call comes next
+            try:
+                fn(*args)
+            except PersistorException as e:
+                errors.append(e)
+        for packet in range(30):
+            stream = {'sniff': numpy.arange(10, dtype=numpy.int16), 'count': packet}
+            if packet == 3:
+                stream['undeclared'] = 1
+            persist(persistor.insert_stream, stream, group)
+        persist(persistor.end_trial, group)
+        persist(persistor.close_database)
+        persistor.close()
+        self.assertEqual([e.node for e in errors], ['Events'])
+        h5file = tables.open_file(self.filename + '.h5')
+        try:
+            # the packets of the failed flush are lost, the later ones written
+            self.assertEqual(list(h5file.root.Trial0001.Events.cols.count[:]), range(10, 30))
+        finally:
+            h5file.close()
+
+
+class TestTrials(PersistorTestCase):
+
+    def test_start_times(self):
+        """Start times are stored when the trial starts, also if it ends without events, and NaN if it never started"""
+        persistor = Persistor()
+        session = persistor.create_database(self.filename, {})
+        persistor.create_trials(PROTOCOL_PARAMETERS, CONTROLLER_PARAMETERS, EVENTS, session, '')
+        persistor.add_trial(1, {'trialNumber': 1}, {'iti': (1, db.Int, 100)}, STREAMS, session, '')
+        persistor.set_trial_start(10.0, 10.5)
+        persistor.insert_event({'response': 1}, session)
+        persistor.add_trial(2, {'trialNumber': 2}, {'iti': (1, db.Int, 100)}, STREAMS, session, '')
+        persistor.set_trial_start(20.0, 20.25)
+        # stopped before its events arrived
+        persistor.add_trial(3, {'trialNumber': 3}, {'iti': (1, db.Int, 100)}, STREAMS, session, '')
+        persistor.close_database()
+        h5file = tables.open_file(self.filename + '.h5')
+        try:
+            trials = h5file.root.Trials
+            self.assertEqual(list(trials.cols.trialNumber[:]), [1, 2, 3])
+            self.assertEqual(list(trials.cols.intended_start_time[:2]), [10.0, 20.0])
+            self.assertEqual(list(trials.cols.start_time[:2]), [10.5, 20.25])
+            self.assertTrue(numpy.isnan(trials.cols.intended_start_time[2]))
+            self.assertTrue(numpy.isnan(trials.cols.start_time[2]))
+        finally:
+            h5file.close()
+
+
+class TestConfig(PersistorTestCase):
+
+    def test_earray_chunkshape(self):
+        config = os.path.join(self.directory, 'voyeur.conf')
+        with open(config, 'w') as f:
+            f.write("[persistor]\n"
+                    "    layout = session\n"
+                    "    [[chunkshape]]\n"
+                    "        events = 128\n"
+                    "        earray = 4096\n")
+        persistor = Persistor.from_config(config)
+        self.assertEqual(persistor.layout, SESSION_LAYOUT)
+        h5file = self.write_session(persistor)
+        try:
+            self.assertEqual(h5file.root.Streams.sniff.chunkshape, (4096,))
+            self.assertEqual(h5file.root.Streams.sniff.nrows, 2 * 25 * 10)
+            self.assertEqual(h5file.root.Trial0001.Events.chunkshape, (128,))
+        finally:
+            h5file.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,218 @@
+import os
+import sys
+import struct
+import unittest
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+# headless, see voyeur.eventloop
+os.environ.setdefault('ETS_TOOLKIT', 'null')
+from voyeur import db
+from voyeur.arduino import SerialPort, SerialCallThread, StreamPlan, parse_serial, CAPABILITY_PUSH, CAPABILITY_CHECKSUM, CAPABILITY_RETRANSMIT
+from voyeur.simulator import SimulatedController, SimulatedSerial
+import voyeur.exceptions as ex
+
+"""Stream decoding, framing and retransmission tests against the simulated controller"""
+
+TRIAL_PARAMETERS = {'trialNumber': (0, db.Int, 1), 'iti': (1, db.Int, 0)}
+
+
+class Clock(object):
+    """Simulated controller clock, advanced by the test"""
+
+    def __init__(self):
+        self.now = 1024.0
+
+    def __call__(self):
+        return self.now
+
+
+def simulated_port(clock=None, **kwargs):
+    """A SerialPort connected to a SimulatedController started on a trial"""
+    kwargs.setdefault('trial_duration', 1e9)
+    if clock is not None:
+        kwargs['clock'] = clock
+    controller = SimulatedController(parameters_format='i', **kwargs)
+    serial = SimulatedSerial(controller, timeout=0.05)
+    port = SerialPort(None, serial_device=serial)
+    port.start_trial(TRIAL_PARAMETERS)
+    return controller, port
+
+
+class TestDecode(unittest.TestCase):
+
+    def test_plan_matches_definition(self):
+        """parse_serial decodes the same values with a definition dictionary and a StreamPlan"""
+        clocks = [Clock(), Clock()]
+        (controller, by_definition), (_, by_plan) = [simulated_port(clock) for clock in clocks]
+        definition = controller.stream_definition()
+        plan = StreamPlan(definition)
+        for packet in range(5):
+            for clock in clocks:
+                clock.now += 0.05
+            expected = by_definition.request_stream(definition)
+            decoded = by_plan.request_stream(plan)
+            self.assertEqual(sorted(decoded), sorted(expected))
+            self.assertEqual(len(decoded['sniff']), 50)
+            self.assertTrue(numpy.array_equal(decoded['sniff'], expected['sniff']))
+            self.assertEqual(decoded['packet_sent_time'], expected['packet_sent_time'])
+
+    def test_decoded_values(self):
+        clock = Clock()
+        controller, port = simulated_port(clock)
+        clock.now += 0.125
+        stream = port.request_stream(StreamPlan(controller.stream_definition()))
+        sniff = controller.channels[1].signal(numpy.arange(125) / 1000.0)
+        self.assertEqual(stream['packet_sent_time'], 125)
+        self.assertEqual(stream['sniff'].dtype, numpy.int16)
+        self.assertTrue(numpy.array_equal(stream['sniff'], sniff))
+
+    def test_value_types(self):
+        """Streams that are not of an array kind decode to lists, except int streams, as they always did"""
+        definition = {'short': (1, 'int', db.Int), 'word': (2, 'unsigned int', db.Int),
+                      'long': (3, 'long', db.Int), 'time': (4, 'unsigned long', db.Int),
+                      'sniff': (5, 'int', db.Int16Array)}
+        bytestream = struct.pack('<2h2H2l2I3h', -1, 2, 3, 4, -5, 6, 7, 8, 10, 11, 12)
+        bytes_per_stream = [4, 4, 8, 8, 6]
+        data = StreamPlan(definition).decode(bytes_per_stream, bytestream)
+        self.assertEqual(data['short'].dtype, numpy.int16)
+        self.assertEqual(data['word'], [3, 4])
+        self.assertEqual(data['long'], [-5, 6])
+        self.assertEqual(data['time'], [7, 8])
+        self.assertEqual(type(data['sniff']), numpy.ndarray)
+        self.assertEqual(list(data['sniff']), [10, 11, 12])
+        arrays = StreamPlan(definition, arrays=True).decode(bytes_per_stream, bytestream)
+        for key in ('word', 'long', 'time'):
+            self.assertEqual(type(arrays[key]), numpy.ndarray)
+            self.assertEqual(list(arrays[key]), data[key])
+
+    def test_ascii_packet(self):
+        data = parse_serial('1,12,-3,*\r\n', {'a': (1, db.Int), 'b': (2, db.Int)}, None)
+        self.assertEqual(data, {'a': 12, 'b': -3})
+
+
+class TestFraming(unittest.TestCase):
+
+    def test_resync_after_garbage(self):
+        clock = Clock()
+        controller, port = simulated_port(clock)
+        plan = StreamPlan(controller.stream_definition())
+        clock.now += 0.01
+        self.assertEqual(len(port.request_stream(plan)['sniff']), 10)
+        garbage = '\x00\xff\x13junk'
+        controller._reply(garbage)
+        clock.now += 0.01
+        stream = port.request_stream(plan)
+        self.assertEqual(len(stream['sniff']), 10)
+        self.assertEqual(port.framer.resyncs, 1)
+        self.assertEqual(port.framer.discarded_bytes, len(garbage))
+        clock.now += 0.01
+        self.assertEqual(len(port.request_stream(plan)['sniff']), 10)
+
+
+class TestStreamModes(unittest.TestCase):
+
+    def push_trial(self, clock, controller, port, plan):
+        port.start_streaming(plan)
+        clock.now += 0.1
+        packets = 0
+        try:
+            while True:
+                port.read_stream(plan)
+                packets += 1
+        except ex.EndOfTrialException:
+            pass
+        self.assertEqual(port.read_stream(plan), {})
+        return packets
+
+    def test_request_mode_after_push_mode(self):
+        clock = Clock()
+        controller, port = simulated_port(clock, trial_duration=0.05, push_interval=0.01)
+        plan = StreamPlan(controller.stream_definition())
+        self.assertEqual(self.push_trial(clock, controller, port, plan), 5)
+        port.start_trial(TRIAL_PARAMETERS)
+        clock.now += 0.01
+        self.assertEqual(len(port.request_stream(plan)['sniff']), 10)
+        clock.now += 0.01
+        port.send_stream_request()
+        self.assertEqual(len(port.read_stream(plan)['sniff']), 10)
+        self.assertEqual(port.framer.available(), 0)
+
+
+class TestRetransmission(unittest.TestCase):
+
+    def request(self, retransmit_tries, packets=10):
+        clock = Clock()
+        controller, port = simulated_port(clock, extended_header=True, corrupt_rate=1.0, seed=1)
+        port.retransmit_tries = retransmit_tries
+        plan = StreamPlan(controller.stream_definition())
+        streams = []
+        for packet in range(packets):
+            clock.now += 0.01
+            streams.append(port.request_stream(plan))
+        return controller, port, streams
+
+    def test_corrupt_packet_is_recovered(self):
+        controller, port, streams = self.request(retransmit_tries=1)
+        self.assertEqual(controller.bytes_corrupted, 10)
+        self.assertEqual(controller.retransmissions, 10)
+        self.assertTrue(all(stream['sniff'] is not None for stream in streams))
+        statistics = port.trial_statistics()
+        self.assertEqual(statistics['corruptPackets'], 10)
+        self.assertEqual(statistics['retransmittedPackets'], 10)
+        self.assertEqual(statistics['lostPackets'], 0)
+
+    def test_corrupt_packet_without_retransmission(self):
+        controller, port, streams = self.request(retransmit_tries=0)
+        self.assertEqual(controller.retransmissions, 0)
+        self.assertTrue(all(stream['sniff'] is None for stream in streams))
+        self.assertEqual(port.trial_statistics()['corruptPackets'], 10)
+
+
+class TestCapabilities(unittest.TestCase):
+
+    def test_capabilities(self):
+        controller, port = simulated_port(extended_header=True)
+        self.assertEqual(port.request_capabilities(),
+                         CAPABILITY_PUSH | CAPABILITY_CHECKSUM | CAPABILITY_RETRANSMIT)
+        controller, port = simulated_port()
+        self.assertTrue(port.supports(CAPABILITY_PUSH))
+        self.assertFalse(port.supports(CAPABILITY_CHECKSUM))
+
+    def test_legacy_controller(self):
+        """Push mode and retransmission fail loudly with controller code that lacks them"""
+        controller, port = simulated_port(legacy=True)
+        self.assertEqual(port.request_capabilities(), 0)
+        self.assertEqual(controller.forced_pins, [])
+        plan = StreamPlan(controller.stream_definition())
+        self.assertRaises(ex.SerialException, port.start_streaming, plan)
+        self.assertFalse(port.streaming)
+        port.retransmit_tries = 1
+        self.assertRaises(ex.SerialException, port.start_trial, TRIAL_PARAMETERS)
+        port.retransmit_tries = 0
+        self.assertTrue(port.start_trial(TRIAL_PARAMETERS))
+        self.assertTrue(port.request_stream(plan))
+
+
+class TestSerialCallThread(unittest.TestCase):
+
+    class Monitor(object):
+        running = False
+
+    def test_restart(self):
+        """A finished serial thread is replaced, with the calls left in its queue"""
+        calls = []
+        thread = SerialCallThread(monitor=self.Monitor())
+        thread.enqueue(calls.append, 1)
+        thread = thread.restarted()
+        self.assertTrue(thread.wait(2000))
+        thread.enqueue(calls.append, 2)
+        restarted = thread.restarted()
+        self.assertTrue(restarted is not thread)
+        self.assertTrue(restarted.wait(2000))
+        self.assertEqual(calls, [1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()